@@ -1,10 +1,9 @@
-import psycopg2
-
 class herokudb:
     def __init__(self):
         self.dbconn = None
 
     def _get_cursor(self):
+        import psycopg2
         self.dbconn = psycopg2.connect("dbname=<my_db> host=<my_db_host> port=5432 user=<my_db_user> password=<my_db_password> sslmode=require")
 
         return self.dbconn.cursor()
@@ -1,36 +1,159 @@
-import psycopg2
-import pickle
-import psycopg2
+# psycopg2 and requests are only imported once they are actually needed,
+# which keeps them out of the cold start of requests that never use them.
 import json
-import requests
 import hmac
-import tempfile
+import secrets
+import string
+from time import monotonic
+
+# How long a looked up endpoint is trusted before asking the database again
+ENDPOINT_TTL = 300
+
+# Seconds to wait for a controller to accept the connection, and then to
+# answer. Alexa itself gives up after about 8.
+FORWARD_TIMEOUT = (2, 5)
+
+# Local IDs are typed in by hand on the controller's setup page
+LOCAL_ID_CHARS = string.ascii_lowercase + string.digits
+LOCAL_ID_LENGTH = 8
+
+UNABLE_TO_CONNECT = "Unable to connect to iTunes controller. Please make sure the iTunes controller server is running and accessable from the internet."
 
 class herokudb:
-    def __init__(self):
+    """The database connection. Kept open from one (warm) invocation to the
+    next, and reopened if it has gone stale. connect can be swapped out for
+    a local Postgres, or a stand-in, along with driver: the DB-API module
+    whose exceptions it raises (psycopg2 unless given)."""
+    def __init__(self, connect=None, driver=None):
+        self.connect = connect or self._connect
+        self._driver = driver
         self.dbconn = None
 
+    @property
+    def driver(self):
+        if self._driver is None:
+            import psycopg2
+            self._driver = psycopg2
+        return self._driver
+
+    @staticmethod
+    def _connect():
+        import psycopg2
+        return psycopg2.connect("dbname=<my_db_name> host=<my_postgres_host> port=5432 user=<my_user> password=<my_password> sslmode=require")
+
     def _get_cursor(self):
-        self.dbconn = psycopg2.connect("dbname=<my_db_name> host=<my_postgres_host> port=5432 user=<my_user> password=<my_password> sslmode=require")
+        if self.dbconn is None or self.dbconn.closed:
+            self.dbconn = self.connect()
 
         return self.dbconn.cursor()
 
-    def __enter__(self):
-        return self._get_cursor()
-
-    def __exit__(self, *args, **kwargs):
+    def _discard(self):
         if self.dbconn is not None:
             try:
                 self.dbconn.close()
             except:
                 print("Unable to close connection")
+        self.dbconn = None
 
+    def run(self, func, *args):
+        """Call func(cursor, *args) and commit. If the connection turns out
+        to have died since it was last used, reconnect and try once more."""
+        lost = (self.driver.OperationalError, self.driver.InterfaceError)
 
-def lambda_handler(event, context):
-    """ Route the incoming request to the proper endpoint based on user
-    """
+        for attempt in (1, 2):
+            try:
+                cursor = self._get_cursor()
+                result = func(cursor, *args)
+                self.dbconn.commit()
+                return result
+            except lost:
+                self._discard()
+                if attempt == 2:
+                    raise
+                print("Database connection lost, reconnecting")
+            except:
+                # Nothing to roll back if it was connecting that failed, and
+                # a failed rollback shouldn't hide what went wrong
+                if self.dbconn is not None:
+                    try:
+                        self.dbconn.rollback()
+                    except:
+                        print("Unable to roll back")
+                raise
 
-    user_id = event['session']['user']['userId']
+class EndpointCache:
+    """userId -> (endpoint, local id), for ttl seconds"""
+    def __init__(self, ttl=ENDPOINT_TTL):
+        self.ttl = ttl
+        self._entries = {}
+
+    def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        if monotonic() >= entry[2]:
+            del self._entries[user_id]
+            return None
+        return entry[:2]
+
+    def set(self, user_id, endpoint, local_id):
+        self._entries[user_id] = (endpoint, local_id, monotonic() + self.ttl)
+
+    def discard(self, user_id):
+        self._entries.pop(user_id, None)
+
+class CircuitBreaker:
+    """Stops forwarding to controllers that aren't there. After failures
+    failed forwards in a row an endpoint is skipped for reset seconds, then
+    one request is let through to see if it has come back."""
+    def __init__(self, failures=3, reset=30):
+        self.failures = failures
+        self.reset = reset
+        self._endpoints = {}  # endpoint -> (failures in a row, skip until)
+
+    def allow(self, endpoint):
+        failures, skip_until = self._endpoints.get(endpoint, (0, 0))
+        if failures < self.failures:
+            return True
+        if monotonic() < skip_until:
+            return False
+        # Give it one more chance, and if that fails skip it again
+        self._endpoints[endpoint] = (self.failures - 1, 0)
+        return True
+
+    def success(self, endpoint):
+        self._endpoints.pop(endpoint, None)
+
+    def failure(self, endpoint):
+        failures = self._endpoints.get(endpoint, (0, 0))[0] + 1
+        self._endpoints[endpoint] = (failures, monotonic() + self.reset)
+
+# Module level, so they live as long as the Lambda container does
+database = herokudb()
+endpoint_cache = EndpointCache()
+circuit_breaker = CircuitBreaker()
+# Keeps the connections to the controllers open between requests
+_session = None
+
+def get_session():
+    global _session
+    if _session is None:
+        import requests
+        _session = requests.Session()
+    return _session
+
+def new_local_id():
+    return ''.join(secrets.choice(LOCAL_ID_CHARS) for _ in range(LOCAL_ID_LENGTH))
+
+def lookup_endpoint(cursor, user_id):
+    """The (endpoint, local id) registered to user_id, creating the user if
+    this is the first we've heard of them."""
+    IntegrityError = database.driver.IntegrityError
+
+    cursor.execute("SELECT endpoint, id FROM users WHERE userid=%s", (user_id, ))
+    row = cursor.fetchone()
+    if row is not None:
+        return row
 
     SQL = """INSERT INTO users (id, userid)
     VALUES (%s,%s)
@@ -38,6 +161,43 @@ def lambda_handler(event, context):
     SET userid=EXCLUDED.userid
     RETURNING endpoint,id"""
 
+    good_local_id=False #failsafe
+    while not good_local_id: 
+        # Generate a local ID (may not be used)
+        local_id=new_local_id()
+        # A failed statement aborts the whole transaction, unless we can
+        # roll back to just before it
+        cursor.execute("SAVEPOINT new_user")
+        try:
+            cursor.execute(SQL, (local_id, user_id, ))
+        except IntegrityError: #We will only get this if the local_id conflicts but the user_id does not
+            # The ON CONFLICT clause handles the case where the userid conflicts
+            cursor.execute("ROLLBACK TO SAVEPOINT new_user")
+            continue
+        else:
+            good_local_id=True
+
+    return cursor.fetchone()
+
+def get_endpoint(user_id):
+    cached = endpoint_cache.get(user_id)
+    if cached is not None:
+        return cached
+
+    endpoint, local_id = database.run(lookup_endpoint, user_id)
+    print(f"Got endpoint {endpoint} for local id {local_id}")
+    # Users who haven't registered a controller yet are looked up again
+    # every time, so they are found as soon as they do.
+    if endpoint is not None:
+        endpoint_cache.set(user_id, endpoint, local_id)
+    return endpoint, local_id
+
+def lambda_handler(event, context):
+    """ Route the incoming request to the proper endpoint based on user
+    """
+
+    user_id = event['session']['user']['userId']
+
     response_data = {
         "version": "1.0",
         "sessionAttribtutes": {},
@@ -48,23 +208,7 @@ def lambda_handler(event, context):
             },
     }
 
-    with herokudb() as cursor:
-        good_local_id=False #failsafe
-        while not good_local_id: 
-            # Generate a local ID (may not be used)
-            # Use the tempfile module to generate a random string
-            local_id=tempfile.mkstemp()[1].split('/')[-1][3:]
-            try:
-                cursor.execute(SQL, (local_id, user_id, ))
-            except IntegrityError: #We will only get this if the local_id conflicts but the user_id does not
-                # The ON CONFLICT clause handles the case where the userid conflicts
-                continue
-            else:
-                good_local_id=True
-                
-        endpoint, local_id = cursor.fetchone()
-        print(f"Got endpoint {endpoint} for local id {local_id}")
-        cursor.connection.commit()
+    endpoint, local_id = get_endpoint(user_id)
 
     if endpoint is None:
         #Prompt the user to register an endpoint
@@ -81,14 +225,32 @@ def lambda_handler(event, context):
         #create a signature with the data and a shared secret
         signature = hmac.new(b"<my_shared_secret>", json_data, 'SHA256').hexdigest()
 
+        if not circuit_breaker.allow(endpoint):
+            print(f"Not forwarding to {endpoint}, it has been failing")
+            endpoint_cache.discard(user_id)
+            response_data['response']['outputSpeech']['text'] = UNABLE_TO_CONNECT
+            return response_data
+
+        import requests
         try:
-            result = requests.post(endpoint, data=json_data,
-                                   headers={'Signature': signature,})
+            result = get_session().post(endpoint, data=json_data,
+                                        headers={'Signature': signature,},
+                                        timeout=FORWARD_TIMEOUT)
         except requests.exceptions.ConnectionError:
-            response_data['response']['outputSpeech']['text'] = "Unable to connect to iTunes controller. Please make sure the iTunes controller server is running and accessable from the internet."
+            circuit_breaker.failure(endpoint)
+            # The controller may have registered a new endpoint since
+            endpoint_cache.discard(user_id)
+            response_data['response']['outputSpeech']['text'] = UNABLE_TO_CONNECT
+            return response_data
+        except requests.exceptions.Timeout:
+            circuit_breaker.failure(endpoint)
+            endpoint_cache.discard(user_id)
+            response_data['response']['outputSpeech']['text'] = "iTunes is not responding properly."
             return response_data
 
+        circuit_breaker.success(endpoint)
         if result.status_code != 200:
+            endpoint_cache.discard(user_id)
             response_data['response']['outputSpeech']['text'] = "iTunes is not responding properly."
 
             # Send a card with the details
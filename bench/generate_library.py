@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""Generate a synthetic iTunes library XML file for benchmarking.
+
+The titles are meant to exercise the same things real libraries do: plenty
+of numbers and ordinals for normalize_text to spell out ("Symphony No. 5",
+"2nd Movement"), the same song title recorded by many artists, and albums
+spread over several discs.
+
+    python3 bench/generate_library.py 100000 /tmp/library-100k.xml"""
+
+import re
+import sys
+import random
+import argparse
+from xml.sax.saxutils import escape
+
+WORDS = ("love blue night heart fire rain river moon summer road home light "
+         "dream city girl boy dance blues song time world sky star gold "
+         "wild sweet lonely last little happy broken midnight morning "
+         "train ocean stone angel devil paradise highway sunday").split()
+
+TITLE_FORMS = (
+    "{word} {word}",
+    "The {word} {word}",
+    "{word} of the {word}",
+    "{word} {word} {word}",
+    "Symphony No. {number} in {key}",
+    "{ordinal} {word}",
+    "{word} Number {number}",
+    "{number} {word}s",
+    "{word} (Live at the {word} {word})",
+    "Piano Sonata No. {number}: {ordinal} Movement",
+)
+
+KEYS = ("C Major", "D Minor", "E-flat Major", "F Minor", "G Major", "A Minor")
+
+def ordinal(number):
+    if 10 <= number % 100 <= 20:
+        suffix = 'th'
+    else:
+        suffix = {1: 'st', 2: 'nd', 3: 'rd'}.get(number % 10, 'th')
+    return f"{number}{suffix}"
+
+def make_name(rng, forms=TITLE_FORMS):
+    fields = {
+        'word': lambda: rng.choice(WORDS).title(),
+        'number': lambda: str(rng.randint(1, 120)),
+        'ordinal': lambda: ordinal(rng.randint(1, 12)),
+        'key': lambda: rng.choice(KEYS),
+    }
+    # Every field gets its own value, even if it appears twice
+    return re.sub(r'{(\w+)}', lambda field: fields[field.group(1)](),
+                  rng.choice(forms))
+
+def make_tracks(num_tracks, rng):
+    """Yield track dicts, album by album"""
+    num_artists = max(10, num_tracks // 40)
+    artists = [f"{rng.choice(WORDS).title()} {rng.choice(WORDS).title()}"
+               f"{' Band' if i % 3 == 0 else ''} {i}" for i in range(num_artists)]
+
+    # Songs that get recorded over and over, by different artists
+    standards = [make_name(rng) for _ in range(max(5, num_tracks // 500))]
+
+    track_id = 1000
+    while track_id - 1000 < num_tracks:
+        artist = rng.choice(artists)
+        album = f"{make_name(rng)} {track_id}"
+        discs = 2 if rng.random() < 0.1 else 1
+        for disc in range(1, discs + 1):
+            for number in range(1, rng.randint(8, 16) + 1):
+                if track_id - 1000 >= num_tracks:
+                    return
+
+                if rng.random() < 0.1:
+                    name = rng.choice(standards)
+                else:
+                    name = make_name(rng)
+
+                yield {
+                    'Track ID': track_id,
+                    'Name': name,
+                    'Artist': artist,
+                    'Album': album,
+                    'Disc Number': disc,
+                    'Disc Count': discs,
+                    'Track Number': number,
+                    'Play Count': rng.randint(0, 50),
+                    'Persistent ID': f"{rng.getrandbits(64):016X}",
+                    'Kind': "MPEG audio file",
+                    'Total Time': rng.randint(120000, 420000),
+                    'Location': f"file:///Users/bench/Music/{track_id}.mp3",
+                }
+                track_id += 1
+
+def value_xml(value):
+    if isinstance(value, int):
+        return f"<integer>{value}</integer>"
+    return f"<string>{escape(value)}</string>"
+
+def write_library(path, num_tracks, seed=0):
+    rng = random.Random(seed)
+    track_ids = []
+
+    with open(path, 'w', encoding='UTF-8') as out:
+        out.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                  '<!DOCTYPE plist PUBLIC "-//Apple Computer//DTD PLIST 1.0//EN" '
+                  '"http://www.apple.com/DTDs/PropertyList-1.0.dtd">\n'
+                  '<plist version="1.0">\n<dict>\n'
+                  '\t<key>Major Version</key><integer>1</integer>\n'
+                  '\t<key>Minor Version</key><integer>1</integer>\n'
+                  '\t<key>Tracks</key>\n\t<dict>\n')
+
+        for track in make_tracks(num_tracks, rng):
+            track_ids.append(track['Track ID'])
+            out.write(f"\t\t<key>{track['Track ID']}</key>\n\t\t<dict>\n")
+            for key, value in track.items():
+                out.write(f"\t\t\t<key>{key}</key>{value_xml(value)}\n")
+            out.write("\t\t</dict>\n")
+
+        out.write('\t</dict>\n\t<key>Playlists</key>\n\t<array>\n')
+
+        playlists = [("Library", track_ids), ("Music", track_ids)]
+        for i in range(max(5, num_tracks // 1000)):
+            size = min(len(track_ids), rng.randint(10, 200))
+            playlists.append((f"{make_name(rng)} Mix {i}", rng.sample(track_ids, size)))
+
+        for i, (name, items) in enumerate(playlists):
+            out.write(f"\t\t<dict>\n\t\t\t<key>Name</key>{value_xml(name)}\n"
+                      f"\t\t\t<key>Playlist ID</key><integer>{i + 1}</integer>\n"
+                      f"\t\t\t<key>Playlist Persistent ID</key>{value_xml(f'{rng.getrandbits(64):016X}')}\n"
+                      "\t\t\t<key>Playlist Items</key>\n\t\t\t<array>\n")
+            for track_id in items:
+                out.write(f"\t\t\t\t<dict><key>Track ID</key><integer>{track_id}</integer></dict>\n")
+            out.write("\t\t\t</array>\n\t\t</dict>\n")
+
+        out.write('\t</array>\n</dict>\n</plist>\n')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('tracks', type=int, help="number of tracks")
+    parser.add_argument('path', help="XML file to write")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    write_library(args.path, args.tracks, args.seed)
+
+if __name__ == "__main__":
+    sys.exit(main())
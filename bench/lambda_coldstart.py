@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""Measure the cold start of the Lambda router (AmazonLambda/iTunes-dist.py).
+
+Each run starts a fresh Python, the way a new Lambda container does, and
+times importing the router, its first invocation and a second (warm) one.
+The database is an in-memory stand-in and the user's controller is a local
+HTTP server, so nothing leaves the machine. requests must be installed as it
+would be in the Lambda package. So should psycopg2, for its import to count
+towards the first invocation; without it the stand-in's own exceptions are
+used, and the first invocation comes out a little fast.
+
+    python3 bench/lambda_coldstart.py --runs 10 --import-budget-ms 150
+
+With a budget, the exit status is 1 when the median goes over it, so a cold
+start regression can fail a build. --importtime lists the slowest imports."""
+
+import os
+import sys
+import json
+import argparse
+import importlib.util
+import subprocess
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from statistics import median
+from time import perf_counter
+
+ROUTER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      'AmazonLambda', 'iTunes-dist.py')
+
+EVENT = {
+    'version': '1.0',
+    'session': {'user': {'userId': 'amzn1.ask.account.COLDSTART'},
+                'application': {'applicationId': 'amzn1.ask.skill.coldstart'}},
+    'request': {'type': 'IntentRequest', 'intent': {'name': 'WhatsPlaying'}},
+}
+
+class StandinDriver:
+    """The exceptions psycopg2 would raise, for when it isn't installed"""
+    class Error(Exception):
+        pass
+
+    class OperationalError(Error):
+        pass
+
+    class InterfaceError(Error):
+        pass
+
+    class IntegrityError(Error):
+        pass
+
+class StandinCursor:
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+
+    def execute(self, sql, args=None):
+        pass
+
+    def fetchone(self):
+        return (self.endpoint, 'coldstrt')
+
+class StandinConnection:
+    """Just enough of a psycopg2 connection for the router"""
+    closed = 0
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+
+    def cursor(self):
+        return StandinCursor(self.endpoint)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+class ControllerHandler(BaseHTTPRequestHandler):
+    """Stands in for a user's controller, answering every request at once"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        body = json.dumps({'version': '1.0', 'response': {
+            'outputSpeech': {'type': 'PlainText', 'text': 'OK'}}}).encode('UTF-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def child():
+    """One cold start. Prints the timings as JSON."""
+    server = HTTPServer(('127.0.0.1', 0), ControllerHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = f"http://127.0.0.1:{server.server_port}/alexa"
+
+    start = perf_counter()
+    spec = importlib.util.spec_from_file_location('router', ROUTER)
+    router = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(router)
+    import_time = perf_counter() - start
+
+    # The router imports psycopg2 itself, when it first needs it, if there
+    # is one to import
+    driver = None if importlib.util.find_spec('psycopg2') else StandinDriver
+    router.database = router.herokudb(lambda: StandinConnection(endpoint), driver)
+
+    start = perf_counter()
+    router.lambda_handler(EVENT, None)
+    first_time = perf_counter() - start
+
+    start = perf_counter()
+    router.lambda_handler(EVENT, None)
+    warm_time = perf_counter() - start
+
+    print(json.dumps({'import_ms': import_time * 1000,
+                      'first_invocation_ms': first_time * 1000,
+                      'warm_invocation_ms': warm_time * 1000}))
+
+def run_child(*options):
+    """Run one cold start in a new Python, stopping with its errors if it fails"""
+    result = subprocess.run([sys.executable, *options, __file__, '--child'],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        sys.exit(f"Cold start run failed with exit code {result.returncode}:\n"
+                 f"{result.stderr}")
+    return result
+
+def slowest_imports(count):
+    """The count slowest imports (cumulative, in ms) of a cold start"""
+    result = run_child('-X', 'importtime')
+    imports = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Only top level imports; their children are counted in them
+        if name.startswith(' ') and not name.startswith('  '):
+            imports.append((int(cumulative) / 1000, name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--import-budget-ms', type=float,
+                        help="fail if the median import time is over this")
+    parser.add_argument('--first-call-budget-ms', type=float,
+                        help="fail if the median first invocation is over this")
+    parser.add_argument('--importtime', action='store_true',
+                        help="list the slowest imports")
+    parser.add_argument('--output', help="write the results here, as JSON")
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child()
+
+    runs = []
+    for _ in range(args.runs):
+        result = run_child()
+        runs.append(json.loads(result.stdout.strip().splitlines()[-1]))
+
+    summary = {name: {'median': median(run[name] for run in runs),
+                      'max': max(run[name] for run in runs)}
+               for name in runs[0]}
+    for name, stats in summary.items():
+        print(f"{name:<22} median {stats['median']:8.2f}  max {stats['max']:8.2f}")
+
+    if args.importtime:
+        print("\nSlowest imports (cumulative ms):")
+        for cumulative, name in slowest_imports(10):
+            print(f"{cumulative:8.2f}  {name}")
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({'runs': runs, 'summary': summary}, output_file, indent=2)
+
+    over_budget = False
+    for name, budget in (('import_ms', args.import_budget_ms),
+                         ('first_invocation_ms', args.first_call_budget_ms)):
+        if budget is not None and summary[name]['median'] > budget:
+            print(f"{name} median of {summary[name]['median']:.2f}ms is over the {budget}ms budget")
+            over_budget = True
+    return 1 if over_budget else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""Check the Lambda router's recovery paths (AmazonLambda/iTunes-dist.py),
+which a healthy database and controller never exercise.
+
+Uses the stand-ins from lambda_coldstart.py, with connections that can be
+made to fail, and a clock that can be moved on:
+
+* herokudb.run reconnects once when the connection has died, gives up when
+  the new one dies too, and rolls back (and re-raises) anything else, even
+  when it failed before there was a connection to roll back
+* the endpoint cache answers repeat requests without the database, until
+  the entry expires, or is discarded because forwarding to it failed
+
+    python3 bench/lambda_router_checks.py
+
+The exit status is 1 if any check fails."""
+
+import os
+import sys
+import importlib.util
+import threading
+from http.server import HTTPServer
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+from lambda_coldstart import (ROUTER, EVENT, StandinDriver, StandinConnection,
+                              StandinCursor, ControllerHandler)
+
+def load_router():
+    spec = importlib.util.spec_from_file_location('router', ROUTER)
+    router = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(router)
+    return router
+
+class FailingCursor(StandinCursor):
+    def __init__(self, endpoint, error):
+        super().__init__(endpoint)
+        self.error = error
+
+    def execute(self, sql, args=None):
+        raise self.error
+
+class Connections:
+    """Hands out stand-in connections, the first few of whose cursors fail
+    with the errors given"""
+    def __init__(self, endpoint, *errors):
+        self.endpoint = endpoint
+        self.errors = list(errors)
+        self.made = []
+        self.rollbacks = 0
+
+    def connect(self):
+        connections = self
+        error = self.errors.pop(0) if self.errors else None
+        if isinstance(error, type):
+            raise error("unable to connect")
+
+        class Connection(StandinConnection):
+            def cursor(self):
+                if error is not None:
+                    return FailingCursor(self.endpoint, error)
+                return super().cursor()
+
+            def rollback(self):
+                connections.rollbacks += 1
+
+        connection = Connection(self.endpoint)
+        self.made.append(connection)
+        return connection
+
+class Clock:
+    """Stands in for time.monotonic"""
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+failures = 0
+
+def check(name, passed):
+    global failures
+    failures += not passed
+    print(f"{'ok' if passed else 'FAIL':4}  {name}")
+
+def lookup(cursor, user_id):
+    cursor.execute("SELECT endpoint, id FROM users WHERE userid=%s", (user_id, ))
+    return cursor.fetchone()
+
+def check_reconnect(router):
+    connections = Connections('http://controller', StandinDriver.OperationalError("gone"))
+    database = router.herokudb(connections.connect, StandinDriver)
+    result = database.run(lookup, 'user')
+    check("a dead connection is replaced, and the query run again",
+          result == ('http://controller', 'coldstrt') and len(connections.made) == 2
+          and connections.made[0].closed and database.dbconn is connections.made[1])
+
+    connections = Connections('http://controller', StandinDriver.InterfaceError("gone"),
+                              StandinDriver.OperationalError("still gone"))
+    database = router.herokudb(connections.connect, StandinDriver)
+    try:
+        database.run(lookup, 'user')
+        raised = None
+    except StandinDriver.Error as e:
+        raised = e
+    check("a second dead connection is given up on",
+          isinstance(raised, StandinDriver.OperationalError) and len(connections.made) == 2
+          and database.dbconn is None)
+
+    connections = Connections('http://controller', StandinDriver.IntegrityError("duplicate"))
+    database = router.herokudb(connections.connect, StandinDriver)
+    try:
+        database.run(lookup, 'user')
+        raised = None
+    except StandinDriver.Error as e:
+        raised = e
+    check("any other error is rolled back and raised, keeping the connection",
+          isinstance(raised, StandinDriver.IntegrityError) and connections.rollbacks == 1
+          and database.dbconn is connections.made[0])
+
+    connections = Connections('http://controller', StandinDriver.Error)
+    database = router.herokudb(connections.connect, StandinDriver)
+    try:
+        database.run(lookup, 'user')
+        raised = None
+    except Exception as e:
+        raised = e
+    check("an error connecting is raised as it is",
+          type(raised) is StandinDriver.Error and not connections.made)
+
+def check_endpoint_cache(router):
+    server = HTTPServer(('127.0.0.1', 0), ControllerHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = f"http://127.0.0.1:{server.server_port}/alexa"
+
+    clock = Clock()
+    router.monotonic = clock
+    connections = Connections(endpoint)
+    router.database = router.herokudb(connections.connect, StandinDriver)
+
+    lookups = []
+    def counted_lookup(cursor, user_id):
+        lookups.append(user_id)
+        return lookup(cursor, user_id)
+    router.lookup_endpoint = counted_lookup
+
+    router.lambda_handler(EVENT, None)
+    router.lambda_handler(EVENT, None)
+    check("a repeat request is answered from the cache", len(lookups) == 1)
+
+    clock.now += router.ENDPOINT_TTL - 1
+    router.lambda_handler(EVENT, None)
+    check("the entry is used until it expires", len(lookups) == 1)
+
+    clock.now += 1
+    router.lambda_handler(EVENT, None)
+    check("an expired entry is looked up again", len(lookups) == 2)
+
+    # The controller goes away: forwarding fails, and the entry is dropped.
+    # The router's kept alive connection has to go first, or the server
+    # never gets to stop.
+    router.get_session().close()
+    server.shutdown()
+    server.server_close()
+    response = router.lambda_handler(EVENT, None)
+    check("a failed forward discards the entry",
+          response['response']['outputSpeech']['text'] == router.UNABLE_TO_CONNECT
+          and router.endpoint_cache.get(EVENT['session']['user']['userId']) is None)
+
+    router.lambda_handler(EVENT, None)
+    check("the next request looks the endpoint up again", len(lookups) == 3)
+
+def main():
+    check_reconnect(load_router())
+    check_endpoint_cache(load_router())
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
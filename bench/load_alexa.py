@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""Replay signed Alexa requests against the /alexa endpoint, the way several
+Echo devices talking at once would.
+
+Builds a corpus of IntentRequests (songs, albums, artists and playlists taken
+from the library, plus the transport and "what's playing" intents), signs
+each one with the skill's shared secret and a fresh timestamp, and sends them
+with the given concurrency. Reports throughput, and p50/p95/p99 latency per
+intent.
+
+By default the server runs in this process, on the Flask test client, with
+the osascript stand-in behind it. Give --url to load a real server (uwsgi
+with iTunesControl.ini, say) instead; it should have the same library loaded:
+
+    python3 bench/load_alexa.py --tracks 10000 --concurrency 8 --requests 2000
+    python3 bench/load_alexa.py --library lib.xml --url http://localhost:4380/alexa"""
+
+import os
+import sys
+import hmac
+import json
+import uuid
+import random
+import argparse
+import tempfile
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from time import perf_counter, sleep
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from generate_library import write_library
+from run_benchmarks import misspell, start_server
+
+SECRET = b"6wQ%8cB!mx_zjqXZBm^+pBWW"
+APPLICATION_ID = "amzn1.ask.skill.3173570a-f916-47e2-9882-fe38778580b6"
+
+# Relative frequency of each intent in the corpus
+INTENT_MIX = {
+    'PlaySong': 30,
+    'PlayAlbum': 15,
+    'PlayArtist': 10,
+    'PlayPlaylist': 10,
+    'WhatsPlaying': 15,
+    'AMAZON.NextIntent': 10,
+    'AMAZON.PreviousIntent': 5,
+    'AMAZON.PauseIntent': 5,
+}
+
+def percentile(durations, fraction):
+    """durations must already be sorted"""
+    return durations[max(0, round(len(durations) * fraction) - 1)]
+
+def make_intent(name, rng, library):
+    """The intent of one request, with its slots filled in from the library"""
+    slots = {}
+    if name in ('PlaySong', 'PlayAlbum', 'PlayArtist'):
+        song = rng.choice(library['songs'])
+        if name == 'PlaySong':
+            slots['title'] = song.name if rng.random() < 0.7 else misspell(song.name, rng)
+            if rng.random() < 0.3:
+                slots['artist'] = song.artist
+        elif name == 'PlayAlbum':
+            slots['album'] = song.album
+        else:
+            slots['artist'] = song.artist
+    elif name == 'PlayPlaylist':
+        slots['playlist'] = rng.choice(library['playlists'])
+
+    return {'name': name,
+            'slots': {slot: {'name': slot, 'value': value}
+                      for slot, value in slots.items()}}
+
+def make_corpus(library, count, rng):
+    """count intents, in the proportions given by INTENT_MIX"""
+    contents = {
+        'songs': list(library.songs.values()),
+        'playlists': [name for name in library.getPlaylistNames()
+                      if name not in ('Library', 'Music')],
+    }
+    names = rng.choices(list(INTENT_MIX), weights=list(INTENT_MIX.values()), k=count)
+    return [make_intent(name, rng, contents) for name in names]
+
+def sign(intent):
+    """The request body and headers for intent, as Alexa would send them"""
+    body = json.dumps({
+        'version': '1.0',
+        'session': {
+            'new': True,
+            'sessionId': f"amzn1.echo-api.session.{uuid.uuid4()}",
+            'application': {'applicationId': APPLICATION_ID},
+        },
+        'request': {
+            'type': 'IntentRequest',
+            'requestId': f"amzn1.echo-api.request.{uuid.uuid4()}",
+            'timestamp': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+            'intent': intent,
+        },
+    }).encode('UTF-8')
+    signature = hmac.new(SECRET, body, 'SHA256').hexdigest()
+    return body, {'Signature': signature, 'Content-Type': 'application/json'}
+
+def test_client_sender(package):
+    """Send through the Flask test client, to the server in this process"""
+    client = package.app.test_client()
+
+    def send(body, headers):
+        response = client.post('/alexa', data=body, headers=headers)
+        return response.status_code, response.get_data()
+    return send
+
+def http_sender(url):
+    import requests
+
+    # A new connection every time: uwsgi's http router closes them after
+    # each request (unless http-keepalive is set), and a pooled connection
+    # it has closed fails the next request sent on it.
+    def send(body, headers):
+        response = requests.post(url, data=body, headers=headers)
+        return response.status_code, response.content
+    return send
+
+def run_load(send, corpus, concurrency, burst, pause):
+    """Send the corpus, concurrency requests at a time. With burst, requests
+    go out in bursts of that many with pause seconds between them.
+    Returns the (intent, seconds, status) of every request, and the total
+    wall time."""
+    def one(intent):
+        body, headers = sign(intent)
+        start = perf_counter()
+        try:
+            status = send(body, headers)[0]
+        except Exception as e:
+            print(f"Request failed: {e}")
+            status = None
+        return (intent['name'], perf_counter() - start, status)
+
+    batches = [corpus]
+    if burst:
+        batches = [corpus[i:i + burst] for i in range(0, len(corpus), burst)]
+
+    results = []
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for i, batch in enumerate(batches):
+            if i and pause:
+                sleep(pause)
+            results.extend(pool.map(one, batch))
+    return results, perf_counter() - start
+
+def report(results, elapsed):
+    by_intent = defaultdict(list)
+    errors = defaultdict(int)
+    for name, duration, status in results:
+        by_intent[name].append(duration)
+        if status != 200:
+            errors[name] += 1
+
+    summary = {'requests': len(results),
+               'seconds': elapsed,
+               'throughput_rps': len(results) / elapsed if elapsed else None,
+               'intents': {}}
+
+    print(f"\n{len(results)} requests in {elapsed:.2f}s "
+          f"({summary['throughput_rps']:.1f} requests/s)\n")
+    print(f"{'intent':<24} {'n':>6} {'errors':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name in sorted(by_intent):
+        durations = sorted(by_intent[name])
+        stats = {
+            'n': len(durations),
+            'errors': errors[name],
+            'p50_ms': percentile(durations, 0.50) * 1000,
+            'p95_ms': percentile(durations, 0.95) * 1000,
+            'p99_ms': percentile(durations, 0.99) * 1000,
+        }
+        summary['intents'][name] = stats
+        print(f"{name:<24} {stats['n']:>6} {stats['errors']:>6} {stats['p50_ms']:>9.2f} "
+              f"{stats['p95_ms']:>9.2f} {stats['p99_ms']:>9.2f}")
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--library', help="library XML (default: a generated one)")
+    parser.add_argument('--tracks', type=int, default=10000,
+                        help="size of the generated library")
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--burst', type=int, default=0,
+                        help="send requests in bursts of this many")
+    parser.add_argument('--pause', type=float, default=1.0,
+                        help="seconds between bursts")
+    parser.add_argument('--url', help="send to this /alexa URL instead of an in-process server")
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'itunescontrol-bench'))
+    parser.add_argument('--output', help="write the summary here, as JSON")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    library_path = args.library and os.path.abspath(args.library)
+    if library_path is None:
+        library_path = os.path.join(args.data_dir, f"library-{args.tracks}-{args.seed}.xml")
+        if not os.path.exists(library_path):
+            print(f"Generating {args.tracks} track library")
+            write_library(library_path, args.tracks, args.seed)
+    output = args.output and os.path.abspath(args.output)
+
+    # The corpus comes from the library as the server itself loads it, so
+    # the server is started even when the requests are going elsewhere.
+    package = start_server(args.data_dir, library_path, stub_scripts=False)[0]
+
+    rng = random.Random(args.seed)
+    corpus = make_corpus(package.itunes_library(), args.requests, rng)
+
+    if args.url:
+        send = http_sender(args.url)
+    else:
+        send = test_client_sender(package)
+
+    results, elapsed = run_load(send, corpus, args.concurrency, args.burst, args.pause)
+    summary = report(results, elapsed)
+    summary['concurrency'] = args.concurrency
+
+    if output:
+        with open(output, 'w') as output_file:
+            json.dump(summary, output_file, indent=2)
+
+if __name__ == "__main__":
+    sys.exit(main())
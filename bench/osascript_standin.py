@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""Stand-in for the osascript script runner, for running the server where
+there is no iTunes (or no Mac). Speaks the same one-JSON-object-per-line
+protocol as the runner in iTunesControl/applescript.py, but only pretends to
+run the scripts and handlers it is given.
+
+Point the server at it from ControlServerConfig.ini:
+
+    [iTunes]
+    scriptrunner = python3 bench/osascript_standin.py
+
+STANDIN_DELAY sets how long (in seconds) each job pretends to take, and
+STANDIN_LOG names a file to append every script received to."""
+
+import os
+import sys
+import json
+import time
+
+NOW_PLAYING = "Some Song\nSome Artist\nplaying"
+
+def main():
+    delay = float(os.environ.get('STANDIN_DELAY', 0))
+    log_path = os.environ.get('STANDIN_LOG')
+
+    for line in sys.stdin:
+        job = json.loads(line)
+        if log_path:
+            with open(log_path, 'a') as log_file:
+                log_file.write(json.dumps(job) + '\n')
+
+        if delay:
+            time.sleep(delay)
+
+        if job.get('handler') == 'now_playing' or 'current track' in job.get('script', ''):
+            output = NOW_PLAYING
+        else:
+            output = ''
+        reply = {'id': job['id'], 'output': output, 'error': None}
+        sys.stdout.write(json.dumps(reply) + '\n')
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""Check the phonetic fallback against names Alexa is known to mishear.
+
+Each example is a request as speech recognition spelled it and the name it
+should find (or None, where the name it sounds closest to is the wrong
+one). The names are indexed by their phonetic keys as SearchIndex indexes
+them, and every request goes through search.sound_match.
+
+    python3 bench/phonetic_examples.py
+
+The exit status is 1 if any example finds the wrong name, or none."""
+
+import os
+import sys
+import types
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Import the package's modules without running its __init__, which starts
+# the whole server
+package = types.ModuleType('iTunesControl')
+package.__path__ = [os.path.join(os.path.dirname(BENCH_DIR), 'iTunesControl')]
+sys.modules['iTunesControl'] = package
+
+from iTunesControl.phonetic import sound_key
+from iTunesControl.search import normalize_key, sound_match, MIN_SOUND_KEY
+
+NAMES = ["Beyoncé", "Lynyrd Skynyrd", "Metallica", "Phil Collins", "Shakira",
+         "Nirvana", "Eminem", "Evanescence", "Aerosmith", "Katy Perry",
+         "Fleetwood Mac", "Shania Twain", "Christopher Cross", "Johnny Cash",
+         "Night Fever", "Love Me Do", "Piano Sonata No. 38: Third Movement"]
+
+EXAMPLES = [
+    ("beyonsay", "Beyoncé"),
+    ("leonard skinnerd", "Lynyrd Skynyrd"),
+    ("mettalika", "Metallica"),
+    ("fil collins", "Phil Collins"),
+    ("chakira", "Shakira"),
+    ("nervana", "Nirvana"),
+    ("emenem", "Eminem"),
+    ("evan essence", "Evanescence"),
+    ("air o smith", "Aerosmith"),
+    ("kaiti peri", "Katy Perry"),
+    ("fleet wood mack", "Fleetwood Mac"),
+    ("shanaia twane", "Shania Twain"),
+    ("cris tofer cross", "Christopher Cross"),
+    ("jonny cash", "Johnny Cash"),
+    ("nite fever", "Night Fever"),
+    ("peeano sonnata no. thirty ate: thurd moovement",
+     "Piano Sonata No. 38: Third Movement"),
+    ("live mead", None),
+]
+
+def main():
+    sounds = {}
+    for name in NAMES:
+        key = normalize_key(name)
+        sound = sound_key(key)
+        if len(sound) >= MIN_SOUND_KEY:
+            sounds.setdefault(sound, []).append(key)
+
+    failures = 0
+    for request, expected in EXAMPLES:
+        found = [key for _, key in sound_match(normalize_key(request), sounds)]
+        wanted = [normalize_key(expected)] if expected else []
+        ok = found == wanted
+        failures += not ok
+        print(f"{'ok' if ok else 'FAIL':4}  {request!r} -> {found[0] if found else None!r}")
+
+    print(f"{len(EXAMPLES) - failures}/{len(EXAMPLES)} examples as expected")
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
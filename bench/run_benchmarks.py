@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""Time the library loading and matching hot paths against synthetic libraries.
+
+Generates (or reuses) libraries of each size with generate_library.py, loads
+them through the server's own code and times:
+
+* loading the XML, and building the search index
+* normalize_text
+* fuzzy_match against the albums
+* the PlaySong, PlayAlbum and PlayPlaylist intents, with the AppleScript
+  calls stubbed out so only our side of the work is measured, and PlaySong
+  again for songs already asked for
+
+Results are written as JSON, and can be compared against an earlier run:
+
+    python3 bench/run_benchmarks.py --sizes 1000 10000 --output new.json --compare old.json"""
+
+import os
+import sys
+import json
+import random
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from datetime import datetime
+from statistics import mean, median
+from time import perf_counter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from generate_library import write_library
+
+DEFAULT_SIZES = (1000, 10000, 100000, 500000)
+
+def summarize(durations):
+    """Summary statistics, in milliseconds, of a list of durations in seconds"""
+    durations = sorted(durations)
+    return {
+        'n': len(durations),
+        'mean_ms': mean(durations) * 1000,
+        'p50_ms': median(durations) * 1000,
+        'p95_ms': durations[max(0, round(len(durations) * 0.95) - 1)] * 1000,
+        'min_ms': durations[0] * 1000,
+        'max_ms': durations[-1] * 1000,
+    }
+
+def time_calls(func, arguments):
+    durations = []
+    for args in arguments:
+        start = perf_counter()
+        func(*args)
+        durations.append(perf_counter() - start)
+    return summarize(durations)
+
+def misspell(text, rng):
+    """Knock one character out of text, the way a bad transcription might"""
+    if len(text) < 6:
+        return text
+    position = rng.randrange(1, len(text) - 1)
+    return text[:position] + text[position + 1:]
+
+def slots(**values):
+    return {'slots': {name: {'value': value} for name, value in values.items()}}
+
+def start_server(workdir, first_library, stub_scripts=True):
+    """Import the server package, configured to run without a tunnel and with
+    the stand-in in place of osascript. With stub_scripts, the script calls
+    don't even reach the stand-in."""
+    with open(os.path.join(workdir, 'ControlServerConfig.ini'), 'w') as config_file:
+        config_file.write("[iTunes]\n"
+                          f"xmllocation = {first_library}\n"
+                          f"scriptrunner = {sys.executable} {os.path.join(BENCH_DIR, 'osascript_standin.py')}\n\n"
+                          "[Alexa]\n\n"
+                          "[Server]\ntunnel = no\n\n")
+    os.chdir(workdir)
+
+    import iTunesControl
+    from iTunesControl import main
+
+    if stub_scripts:
+        # Only our side of each intent is being timed
+        main.queue_script = lambda *args: None
+        main.run_script = lambda *args: ''
+
+    # Let the server's own first load finish, so it doesn't skew any timing
+    iTunesControl.get_iTunes_lib()
+    return iTunesControl, main
+
+def bench_size(package, main, path, queries, rng):
+    from iTunesControl.library import Library
+    from iTunesControl.search import SearchIndex, normalize_text
+
+    results = {}
+
+    start = perf_counter()
+    library = Library(path)
+    results['load_library'] = summarize([perf_counter() - start])
+
+    start = perf_counter()
+    SearchIndex(library)
+    results['build_index'] = summarize([perf_counter() - start])
+
+    tracemalloc.start()
+    library = Library(path)
+    results['load_library']['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    del library
+
+    package.config['iTunes']['xmllocation'] = path
+    package.get_iTunes_lib()
+
+    library, index = package.library_state()
+    songs = rng.sample(list(library.songs.values()), min(queries, len(library.songs)))
+    albums = [song.album for song in songs]
+    playlists = rng.sample(library.getPlaylistNames(), min(queries, len(index.playlist_names)))
+
+    results['normalize_text'] = time_calls(normalize_text,
+                                           [(song.name.lower(), ) for song in songs])
+    results['fuzzy_match_album'] = time_calls(
+        main.fuzzy_match,
+        [(misspell(album, rng), index.album_search, index.album_names) for album in albums])
+    results['play_song_exact'] = time_calls(
+        main.play_song, [(slots(title=song.name), ) for song in songs])
+    # The same requests again, now answered from main.resolved
+    results['play_song_repeated'] = time_calls(
+        main.play_song, [(slots(title=song.name), ) for song in songs])
+    results['play_song_misspelled'] = time_calls(
+        main.play_song, [(slots(title=misspell(song.name, rng)), ) for song in songs])
+    results['play_song_with_artist'] = time_calls(
+        main.play_song, [(slots(title=song.name, artist=song.artist), ) for song in songs])
+    results['play_album'] = time_calls(
+        main.play_album, [(slots(album=misspell(album, rng)), ) for album in albums])
+    results['play_playlist'] = time_calls(
+        main.play_playlist, [(slots(playlist=playlist), ) for playlist in playlists])
+
+    return results
+
+def compare(results, baseline_path):
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)['results']
+
+    print(f"\n{'size':>8} {'benchmark':<24} {'before ms':>10} {'after ms':>10} {'ratio':>7}")
+    for size, benchmarks in results.items():
+        for name, stats in benchmarks.items():
+            before = baseline.get(size, {}).get(name)
+            if before is None:
+                continue
+            ratio = stats['mean_ms'] / before['mean_ms'] if before['mean_ms'] else float('inf')
+            print(f"{size:>8} {name:<24} {before['mean_ms']:>10.3f} {stats['mean_ms']:>10.3f} {ratio:>7.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help="library sizes, in tracks")
+    parser.add_argument('--queries', type=int, default=200,
+                        help="queries timed per benchmark")
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'itunescontrol-bench'),
+                        help="where generated libraries are kept between runs")
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help="earlier results file to compare against")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    paths = {}
+    for size in args.sizes:
+        paths[size] = os.path.join(args.data_dir, f"library-{size}-{args.seed}.xml")
+        if not os.path.exists(paths[size]):
+            print(f"Generating {size} track library")
+            write_library(paths[size], size, args.seed)
+
+    # The server reads its config from the working directory, so we move
+    output = os.path.abspath(args.output)
+    baseline = os.path.abspath(args.compare) if args.compare else None
+    package, main_module = start_server(args.data_dir, paths[args.sizes[0]])
+
+    rng = random.Random(args.seed)
+    results = {}
+    for size in args.sizes:
+        print(f"Benchmarking {size} tracks")
+        results[str(size)] = bench_size(package, main_module, paths[size], args.queries, rng)
+
+    report = {
+        'meta': {
+            'timestamp': datetime.utcnow().isoformat() + 'Z',
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'queries': args.queries,
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+    with open(output, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f"Results written to {output}")
+
+    if baseline:
+        compare(results, baseline)
+
+if __name__ == "__main__":
+    sys.exit(main())
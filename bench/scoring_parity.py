@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""Check that iTunesControl.scoring gives the same matches fuzzywuzzy does.
+
+Builds normalized title, artist and album keys for a synthetic library,
+then for a sample of queries (misspelled, transposed and exact) compares
+scoring.extract with a plain fuzz.ratio loop over the same keys, and
+scoring.ratio with fuzz.ratio pair by pair. Also times both.
+
+    python3 bench/scoring_parity.py --tracks 10000 --queries 200
+
+The exit status is 1 if any score differs. fuzzywuzzy should have
+python-Levenshtein installed, as the server's requirements do; its pure
+Python fallback scores a little differently from both."""
+
+import os
+import sys
+import types
+import random
+import argparse
+from time import perf_counter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+# Import the package's modules without running its __init__, which starts
+# the whole server
+package = types.ModuleType('iTunesControl')
+package.__path__ = [os.path.join(os.path.dirname(BENCH_DIR), 'iTunesControl')]
+sys.modules['iTunesControl'] = package
+
+from fuzzywuzzy import fuzz
+from iTunesControl import scoring
+from iTunesControl.search import normalize_key
+from generate_library import make_tracks
+from run_benchmarks import misspell
+
+def transpose(text, rng):
+    """Swap two neighbouring characters of text"""
+    if len(text) < 4:
+        return text
+    position = rng.randrange(0, len(text) - 1)
+    return text[:position] + text[position + 1] + text[position] + text[position + 2:]
+
+def reference_extract(query, keys, threshold):
+    scored = ((fuzz.ratio(key, query), key) for key in keys)
+    return [match for match in scored if match[0] >= threshold]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tracks', type=int, default=10000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    tracks = list(make_tracks(args.tracks, rng))
+    keys = {field: sorted({normalize_key(track[field]) for track in tracks})
+            for field in ('Name', 'Artist', 'Album')}
+
+    print(f"scoring backend: {'rapidfuzz' if scoring.rapid_fuzz else 'fuzzywuzzy'}, "
+          f"fuzzywuzzy using {fuzz.SequenceMatcher.__module__}")
+
+    mismatches = 0
+    timings = {'scoring': 0, 'fuzzywuzzy': 0}
+    for _ in range(args.queries):
+        field = rng.choice(list(keys))
+        query = rng.choice(keys[field])
+        query = rng.choice((query, misspell(query, rng), transpose(query, rng)))
+        threshold = rng.choice((88, 89))
+
+        start = perf_counter()
+        result = sorted(scoring.extract(query, keys[field], threshold))
+        timings['scoring'] += perf_counter() - start
+
+        start = perf_counter()
+        expected = sorted(reference_extract(query, keys[field], threshold))
+        timings['fuzzywuzzy'] += perf_counter() - start
+
+        if result != expected:
+            mismatches += 1
+            print(f"extract({query!r}, {field}, {threshold}): "
+                  f"{sorted(set(result) ^ set(expected))}")
+
+    pairs = 0
+    for field, field_keys in keys.items():
+        for key in rng.sample(field_keys, min(len(field_keys), 2000)):
+            other = rng.choice((rng.choice(field_keys), misspell(key, rng), transpose(key, rng), ''))
+            pairs += 1
+            if scoring.ratio(key, other) != fuzz.ratio(key, other):
+                mismatches += 1
+                print(f"ratio({key!r}, {other!r}): {scoring.ratio(key, other)} "
+                      f"!= {fuzz.ratio(key, other)}")
+
+    print(f"{args.queries} queries, {pairs} pairs, {mismatches} mismatches")
+    for name, total in timings.items():
+        print(f"{name:<12} {total / args.queries * 1000:8.2f}ms per query")
+    return 1 if mismatches else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
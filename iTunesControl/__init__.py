@@ -1,73 +1,302 @@
-from time import sleep
-from threading import Thread
-from libpytunes import Library
+from time import sleep, perf_counter, monotonic
+from threading import Thread, Lock
+import os
+import gc
+import atexit
+import hashlib
 import flask
 import signal
-import uwsgi
 import subprocess
 import configparser
 import requests
 
-_itunes_library = None
+try:
+  import uwsgi
+except ImportError:
+  # Not running under uwsgi (the flask development server in run.py, say)
+  uwsgi = None
 
-itunes_library = lambda:_itunes_library
+from .metrics import span
+from .snapshot import load_snapshot
+from .store import open_store
+from .loader import run_loader, FAILED, UNCHANGED, LOADER_TIMEOUT
+
+# phase -> seconds from the start of the import to reaching it
+startup_began = perf_counter()
+startup_phases = {}
+
+def startup_phase(phase):
+  """Note the time startup reached phase, the first time it does"""
+  if phase in startup_phases:
+    return
+  startup_phases[phase] = perf_counter() - startup_began
+  print(f"Startup: {phase} after {startup_phases[phase]:.2f}s")
+
+# The loaded library and its search index, swapped together as one unit,
+# along with a generation number counting the swaps. Anything remembered
+# about one library (see ResolvedCache) is tagged with its generation.
+_library_state = (None, None, 0)
+
+library_state = lambda:_library_state[:2]
+versioned_library_state = lambda:_library_state
+itunes_library = lambda:_library_state[0]
+search_index = lambda:_library_state[1]
+
+def set_library_state(library, index):
+  global _library_state
+  _library_state = (library, index, _library_state[2] + 1)
+
+# (path, mtime, size, content hash) of the XML the current state came from
+_library_source = None
+_reload_lock = Lock()
 
 #Load the config (if any)
 config = configparser.ConfigParser()
 config.read('ControlServerConfig.ini')
 
-#make sure it is initalized properly
-if not 'iTunes' in config:
-  config['iTunes'] = {}
+def save_config():
+  with open('ControlServerConfig.ini', 'w') as configfile:
+    config.write(configfile)
+
+#make sure it is initalized properly, and save it if it wasn't
+missing = [section for section in ('iTunes', 'Alexa') if not section in config]
+for section in missing:
+  config[section] = {}
+
+if missing:
+  save_config()
 
-if not 'Alexa' in config:
-  config['Alexa'] = {}
+startup_phase('config')
 
-# and save for good measure
-with open('ControlServerConfig.ini', 'w') as configfile:
-  config.write(configfile)
+# Open a tunnel for external access, unless the server is reachable some
+# other way (or is just being benchmarked)
+use_tunnel = config.getboolean('Server', 'tunnel', fallback=True)
+ngrok = None
+tunnel_owner = None
 
-# Open a tunnel for external access
-ngrok=subprocess.Popen(['./ngrok','http','4380'],stdout=subprocess.DEVNULL)
+def start_tunnel():
+  """Start the ngrok tunnel, replacing any already running"""
+  global ngrok, tunnel_owner
+  if ngrok is not None:
+    ngrok.terminate()
+    ngrok.communicate()  #wait for process to finish
+  ngrok=subprocess.Popen(['./ngrok','http','4380'],stdout=subprocess.DEVNULL)
+  tunnel_owner = os.getpid()
+
+if use_tunnel:
+  start_tunnel()
 
 #Get the public URL
 def get_tun_url():
-  tuninfo=requests.get('http://localhost:4040/api/tunnels/command_line')
+  tuninfo=requests.get('http://localhost:4040/api/tunnels/command_line', timeout=2)
   if tuninfo.status_code != 200:
     return None
   pub_url = tuninfo.json()['public_url']
   return pub_url
 
-def get_iTunes_lib():
-  global _itunes_library
+def wait_for_tunnel(timeout=30):
+  """The tunnel's public URL, once ngrok has one, polling its API with
+  backoff. None if there still isn't one after timeout seconds."""
+  deadline = monotonic() + timeout
+  delay = 0.1
+  while True:
+    try:
+      pub_url = get_tun_url()
+    except (requests.exceptions.RequestException, ValueError, KeyError):
+      # ngrok isn't listening yet, or has no tunnel to report
+      pub_url = None
+
+    if pub_url is not None:
+      return pub_url
+
+    if monotonic() + delay > deadline:
+      return None
+
+    sleep(delay)
+    delay = min(delay * 2, 2)
+
+def file_digest(path):
+  digest = hashlib.sha1()
+  with open(path, 'rb') as lib_file:
+    for chunk in iter(lambda: lib_file.read(1024 * 1024), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+def library_location():
   # Read in the libary location
   lib_loc = config["iTunes"].get("xmllocation",
                                  "~/Music/iTunes/iTunes Music Library.xml")
-  "/Media/iTunes/iTunes Library.xml"
-  try:
-    _itunes_library = Library(lib_loc)
-  except FileNotFoundError:
-    print(f"Unable to load iTunes library: File ({lib_loc}) not found.")
-    _itunes_library = None
+  return os.path.expanduser(lib_loc)
+
+# The last library loaded, ready to use, kept next to the config. With
+# backend = sqlite it is kept in a database and queried in place (see
+# store.py), rather than held in memory.
+library_backend = config["iTunes"].get("backend", "memory")
+database_path = config["iTunes"].get("database", "Library.sqlite")
+loader_timeout = config["iTunes"].getfloat("loadertimeout", LOADER_TIMEOUT)
+if library_backend == "sqlite":
+  snapshot_path = database_path
+  load_snapshot = open_store
+else:
+  snapshot_path = config["iTunes"].get("snapshot", "LibrarySnapshot.pickle")
+
+# With several uwsgi workers, the library the master loads on startup is
+# shared by all of them copy-on-write, but one loaded later can't be: each
+# worker unpickling the snapshot would hold a whole copy of its own. So a
+# library held in memory is written to the database as well, and the workers
+# move over to that. Like any file, it is mapped once for all of them.
+share_database = library_backend != "sqlite" and uwsgi is not None and uwsgi.numproc > 1
+
+def load_latest(accept):
+  """The library last loaded, as load_snapshot returns it. From the database
+  when the workers share that."""
+  if share_database:
+    return open_store(database_path, accept)
+  return load_snapshot(snapshot_path, accept)
+
+# uwsgi signal telling the workers there is a new library to load, sent by
+# whichever process loaded it
+LIBRARY_SIGNAL = 17
+
+def use_snapshot(snapshot):
+  global _library_source
+  source, library, index = snapshot
+  set_library_state(library, index)
+  _library_source = source
+  print(f"Loaded library snapshot of {index.num_tracks} tracks")
+
+def load_library_snapshot(latest=False):
+  """Switch to the library in the snapshot, unless it's the one we have.
+  Done on startup, so that get_iTunes_lib only has to reparse if the XML
+  has changed, and (with latest, see load_latest) by uwsgi workers when
+  another process has loaded a new library."""
+  lib_loc = library_location()
+  accept = lambda source: source[0] == lib_loc and source != _library_source
+  with _reload_lock:
+    snapshot = load_latest(accept) if latest else load_snapshot(snapshot_path, accept)
+    if snapshot is not None:
+      use_snapshot(snapshot)
+
+def library_changed(signum):
+  """uwsgi signal handler, run by the workers when there's a new snapshot"""
+  # It may be for a different file, if the location was changed elsewhere
+  config.read('ControlServerConfig.ini')
+  load_library_snapshot(latest=True)
+
+def signal_workers():
+  """Tell the other processes there's a new library to load"""
+  if uwsgi is not None:
+    try:
+      uwsgi.signal(LIBRARY_SIGNAL)
+    except Exception as e:
+      print(f"Unable to signal the workers: {e}")
+
+def get_iTunes_lib():
+  global _library_source
+  lib_loc = library_location()
+
+  with _reload_lock:
+    try:
+      stat = os.stat(lib_loc)
+    except FileNotFoundError:
+      print(f"Unable to load iTunes library: File ({lib_loc}) not found.")
+      set_library_state(None, None)
+      _library_source = None
+      return
+
+    source = (lib_loc, stat.st_mtime_ns, stat.st_size)
+    if _library_source is not None and _library_source[:3] == source:
+      return  # Nothing has touched the file since we last loaded it
+
+    # Another process (a uwsgi worker given a new library location, say)
+    # may already have loaded the file as it is now
+    snapshot = load_latest(lambda snapshot_source: snapshot_source[:3] == source)
+    if snapshot is not None:
+      use_snapshot(snapshot)
+      return
+
+    digest = file_digest(lib_loc)
+    if _library_source is not None and _library_source[0] == lib_loc and \
+       _library_source[3] == digest:
+      # Touched, but not actually changed
+      _library_source = source + (digest, )
+      return
+
+    # Parse and index in another process, then just swap in the result
+    full_source = source + (digest, )
+    with span('library_load'):
+      loaded = run_loader(lib_loc, snapshot_path, full_source, library_backend,
+                          database_path if share_database else None, loader_timeout)
+    if loaded == FAILED:
+      # Keep what we have, and try again next time around.
+      return
+    if loaded == UNCHANGED:
+      # Only play counts changed: nothing to swap in, and nothing for
+      # anything remembered about this library to be out of date with
+      _library_source = full_source
+      return
+
+    with span('library_swap'):
+      snapshot = load_latest(lambda snapshot_source: snapshot_source == full_source)
+    if snapshot is None:
+      print("Unable to load iTunes library: snapshot missing")
+      return
+
+    use_snapshot(snapshot)
+    signal_workers()
 
 def update_itunes_library():
   while True:
+    if uwsgi is not None:
+      # The library location may have been changed by one of the workers
+      config.read('ControlServerConfig.ini')
     get_iTunes_lib()
     # Wait 5 minutes, then run again.
     sleep(300)
 
 def shutdown(*args, **kwargs):
-  print("Killing ngrok process")
-  ngrok.kill()
+  if ngrok is not None and os.getpid() == tunnel_owner:
+    print("Killing ngrok process")
+    ngrok.kill()
+  main.executor.close()
+
+def start_updates():
+  update_thread = Thread(target=update_itunes_library, daemon=True)
+  update_thread.start()
+
+def worker_started():
+  """uwsgi post fork hook, run as each worker starts"""
+  # The master may not have the latest library, if this worker replaces
+  # one that died
+  library_changed(None)
+  # The first worker is the one that keeps the library up to date, and
+  # registers the tunnel
+  if uwsgi.worker_id() == 1:
+    start_updates()
+    if use_tunnel:
+      register_in_background()
 
-update_thread = Thread(target=update_itunes_library, daemon=True)
-update_thread.start()
-uwsgi.atexit = shutdown
+# Under uwsgi, everything here runs once, in the master, before the workers
+# are forked from it. So there is one ngrok, and one copy of the library as
+# it was at startup shared by all the workers. The master doesn't start any
+# threads: a lock held by a thread as the workers were forked would stay
+# locked in them for good.
+load_library_snapshot()
+startup_phase('library')
+
+if uwsgi is not None:
+  uwsgi.register_signal(LIBRARY_SIGNAL, 'workers', library_changed)
+  uwsgi.post_fork_hook = worker_started
+  uwsgi.atexit = shutdown
+else:
+  start_updates()
+  atexit.register(shutdown)
 
 app = flask.Flask(__name__)
 
-def register_public():
-  pub_url = get_tun_url()
+def register_public(pub_url=None):
+  if pub_url is None:
+    pub_url = get_tun_url()
   print(f"Registering tunnel URL of {pub_url}/alexa")
   if pub_url is None:
     return
@@ -84,14 +313,59 @@ def register_public():
   reg_result = requests.post(URL,
                                json={'userid': user_id,
                                      'endpointurl': pub_url,},
-                               headers={'x-api-key': api_key,})
+                               headers={'x-api-key': api_key,},
+                               timeout=10)
 
   print(f"Registered URL {pub_url} to user {user_id} with result {reg_result.text}")
   return reg_result
 
-#give the tunnel 3 seconds to establish before checking
-sleep(3)
-register_public()
+# How many times to try registering the tunnel URL, backing off from 1
+# second between tries up to REGISTER_MAX_DELAY
+REGISTER_ATTEMPTS = 10
+REGISTER_MAX_DELAY = 60
+
+def connect_tunnel():
+  """Wait for the tunnel to come up, then register its URL, retrying until
+  the registration goes through"""
+  pub_url = wait_for_tunnel()
+  if pub_url is None:
+    print("Unable to get public URL: the ngrok tunnel did not come up")
+    return
+  startup_phase('tunnel')
+
+  delay = 1
+  for attempt in range(REGISTER_ATTEMPTS):
+    try:
+      reg_result = register_public(pub_url)
+    except requests.exceptions.RequestException as e:
+      print(f"Unable to register tunnel URL: {e}")
+    else:
+      # None means there's no user ID to register it to yet
+      if reg_result is None:
+        return
+      if reg_result.status_code == 200:
+        startup_phase('registered')
+        return
+
+    sleep(delay)
+    delay = min(delay * 2, REGISTER_MAX_DELAY)
+
+  print(f"Giving up registering the tunnel URL after {REGISTER_ATTEMPTS} attempts")
+
+def register_in_background():
+  """Register the tunnel once it's up, without holding anything up"""
+  Thread(target=connect_tunnel, daemon=True).start()
+
+if use_tunnel and uwsgi is None:
+  # (under uwsgi, the first worker does this once it starts)
+  register_in_background()
 
 from . import main
-from . import control
\ No newline at end of file
+from . import control
+
+startup_phase('serving')
+
+if uwsgi is not None and hasattr(gc, 'freeze'):
+  # Keep the garbage collector from touching (and so copying) the objects
+  # the workers share with the master until they change them.
+  gc.freeze()
\ No newline at end of file
@@ -0,0 +1,281 @@
+"""Run AppleScript through one long-lived process rather than starting a new
+osascript for every command.
+
+The runner is a small JavaScript for Automation program, run by osascript,
+that reads jobs from its stdin one JSON object per line and writes back one
+JSON line per job: {"id": ..., "output": ..., "error": ...}. A job is one of
+
+    {"id": ..., "script": source}
+        compile and run a one-off script
+    {"id": ..., "compile": name, "script": source}
+        compile a script of handlers once, and keep it under name
+    {"id": ..., "call": name, "handler": handler, "args": [...]}
+        call a handler in a script compiled earlier, with arguments
+
+Any program speaking the same protocol can be used instead (see
+bench/osascript_standin.py), which is how the server is exercised on machines
+without iTunes."""
+
+import os
+import json
+import select
+import subprocess
+from threading import Lock
+from time import perf_counter, monotonic
+
+RUNNER_SOURCE = r"""
+ObjC.import('Foundation');
+ObjC.import('OSAKit');
+
+var compiled = {};
+
+function reply(stdout, message) {
+    var line = $(JSON.stringify(message) + '\n');
+    stdout.writeData(line.dataUsingEncoding($.NSUTF8StringEncoding));
+}
+
+function descriptor(value) {
+    if (Array.isArray(value)) {
+        var list = $.NSAppleEventDescriptor.listDescriptor;
+        for (var i = 0; i < value.length; i++) {
+            list.insertDescriptorAtIndex(descriptor(value[i]), i + 1);
+        }
+        return list;
+    }
+    if (typeof value === 'number') {
+        return $.NSAppleEventDescriptor.descriptorWithInt32(value);
+    }
+    return $.NSAppleEventDescriptor.descriptorWithString(String(value));
+}
+
+function failure(job, error) {
+    var message = error[0].objectForKey('NSAppleScriptErrorMessage');
+    return {id: job.id, output: '', error: ObjC.unwrap(message) || 'AppleScript error'};
+}
+
+function execute(job) {
+    var error = Ref();
+    var result;
+
+    if (job.call !== undefined) {
+        var script = compiled[job.call];
+        if (script === undefined) {
+            return {id: job.id, output: '', error: 'No compiled script named ' + job.call};
+        }
+        var args = $.NSMutableArray.array;
+        (job.args || []).forEach(function (arg) { args.addObject(descriptor(arg)); });
+        result = script.executeHandlerWithNameArgumentsError(job.handler, args, error);
+    } else {
+        var script = $.OSAScript.alloc.initWithSourceLanguage(
+            job.script, $.OSALanguage.languageForName('AppleScript'));
+        if (!script.compileAndReturnError(error)) {
+            return failure(job, error);
+        }
+        if (job.compile !== undefined) {
+            compiled[job.compile] = script;
+            return {id: job.id, output: '', error: null};
+        }
+        result = script.executeAndReturnError(error);
+    }
+
+    if (result.isNil()) {
+        return failure(job, error);
+    }
+    return {id: job.id, output: ObjC.unwrap(result.stringValue) || '', error: null};
+}
+
+function run() {
+    var stdin = $.NSFileHandle.fileHandleWithStandardInput;
+    var stdout = $.NSFileHandle.fileHandleWithStandardOutput;
+    var newline = $('\n').dataUsingEncoding($.NSUTF8StringEncoding);
+    var buffer = $.NSMutableData.data;
+
+    while (true) {
+        var data = stdin.availableData;
+        if (data.length == 0) {
+            return;  // stdin closed: the server has gone away
+        }
+        buffer.appendData(data);
+
+        while (true) {
+            var found = buffer.rangeOfDataOptionsRange(newline, 0, $.NSMakeRange(0, buffer.length));
+            if (found.length == 0) {
+                break;
+            }
+            var line = buffer.subdataWithRange($.NSMakeRange(0, found.location));
+            buffer.replaceBytesInRangeWithBytesLength($.NSMakeRange(0, found.location + 1), null, 0);
+
+            var text = $.NSString.alloc.initWithDataEncoding(line, $.NSUTF8StringEncoding).js;
+            var job = JSON.parse(text);
+            try {
+                reply(stdout, execute(job));
+            } catch (e) {
+                reply(stdout, {id: job.id, output: '', error: String(e)});
+            }
+        }
+    }
+}
+"""
+
+RUNNER_COMMAND = ['osascript', '-l', 'JavaScript', '-e', RUNNER_SOURCE]
+
+# Seconds a job may take before the runner is taken to be stuck (on a
+# dialog iTunes is showing, say)
+JOB_TIMEOUT = 30
+
+class ScriptError(RuntimeError):
+    """The script runner could not run a job at all"""
+
+class ScriptResult:
+    def __init__(self, output, error, elapsed):
+        self.output = output
+        self.error = error
+        self.elapsed = elapsed  # seconds, as seen from our side of the pipe
+
+class ScriptExecutor:
+    """Feeds scripts to a single, persistent runner process. The process is
+    started on first use, and started again if it has died or a job takes
+    longer than timeout seconds (or the timeout given for that job)."""
+
+    def __init__(self, command=None, timeout=JOB_TIMEOUT):
+        self.command = command or RUNNER_COMMAND
+        self.timeout = timeout
+        self._proc = None
+        self._output = b''  # what the runner has written past the last reply
+        self._pid = None  # the process that started the runner
+        self._job_id = 0
+        self._lock = Lock()
+
+        # name -> source of the handler scripts to compile in every runner
+        self._scripts = {}
+
+    def _forget_inherited(self):
+        if self._proc is not None and self._pid != os.getpid():
+            # We are a forked copy (a uwsgi worker, say). The runner belongs
+            # to the parent, and talking to it too would mix up the replies.
+            self._proc = None
+
+    def _running(self):
+        self._forget_inherited()
+        return self._proc is not None and self._proc.poll() is None
+
+    def _start(self):
+        self.close()
+        self._pid = os.getpid()
+        self._output = b''
+        self._proc = subprocess.Popen(self.command,
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE)
+
+        # A new runner has nothing compiled yet
+        for name, source in self._scripts.items():
+            self._compile(name, source)
+
+    def _compile(self, name, source):
+        self._job_id += 1
+        reply = self._send({'id': self._job_id, 'compile': name, 'script': source},
+                           self.timeout)
+        if reply.get('error') is not None:
+            raise ScriptError(f"Unable to compile {name}: {reply['error']}")
+
+    def _read_line(self, deadline, timeout):
+        """The next line the runner writes, waiting until deadline (timeout
+        seconds from the job being sent) at most"""
+        while b'\n' not in self._output:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                # Whatever it's stuck on, a new runner won't be
+                self.close()
+                raise ScriptError(f"Script runner took more than {timeout}s, "
+                                  "and was stopped")
+
+            ready, _, _ = select.select([self._proc.stdout], [], [], remaining)
+            if ready:
+                data = os.read(self._proc.stdout.fileno(), 65536)
+                if not data:
+                    raise EOFError("Script runner exited")
+                self._output += data
+
+        line, _, self._output = self._output.partition(b'\n')
+        return line.decode('UTF-8')
+
+    def _send(self, job, timeout):
+        if not self._running():
+            self._start()
+
+        deadline = monotonic() + timeout
+        self._proc.stdin.write((json.dumps(job) + '\n').encode('UTF-8'))
+        self._proc.stdin.flush()
+
+        reply = json.loads(self._read_line(deadline, timeout))
+        if reply.get('id') != job['id']:
+            raise ValueError(f"Script runner replied to job {reply.get('id')}, "
+                             f"not {job['id']}")
+        return reply
+
+    def run(self, script):
+        """Compile and run a one-off script"""
+        return self._execute({'script': script})
+
+    def register(self, name, source):
+        """Have a script of handlers compiled when the runner is next
+        started, without starting it now"""
+        with self._lock:
+            self._scripts[name] = source
+
+    def compile(self, name, source):
+        """Compile a script of handlers, to be called by name from then on.
+        It is compiled again whenever the runner has to be restarted."""
+        with self._lock:
+            self._scripts[name] = source
+            try:
+                if not self._running():
+                    self._start()  # which compiles everything registered
+                else:
+                    self._compile(name, source)
+            except (OSError, EOFError, ValueError) as e:
+                self.close()
+                raise ScriptError(f"Unable to compile {name}: {e}")
+
+    def call(self, name, handler, *args, timeout=None):
+        """Call a handler in a compiled script. Arguments may be strings,
+        numbers or lists of those. timeout, if given, replaces the
+        executor's for this call."""
+        return self._execute({'call': name, 'handler': handler,
+                              'args': list(args)}, timeout)
+
+    def _execute(self, job, timeout=None):
+        timeout = timeout or self.timeout
+        with self._lock:
+            self._job_id += 1
+            job['id'] = self._job_id
+
+            start = perf_counter()
+            try:
+                reply = self._send(job, timeout)
+            except (OSError, EOFError, ValueError):
+                # The runner died (or was never there). Give it one more try
+                # with a fresh process before giving up. A job that timed out
+                # isn't tried again: it would most likely just time out again.
+                try:
+                    self._start()
+                    reply = self._send(job, timeout)
+                except (OSError, EOFError, ValueError) as e:
+                    self.close()
+                    raise ScriptError(f"Unable to run script: {e}")
+
+            return ScriptResult(reply.get('output', ''), reply.get('error'),
+                                perf_counter() - start)
+
+    def close(self):
+        self._forget_inherited()
+        if self._proc is None:
+            return
+
+        try:
+            self._proc.stdin.close()
+        except OSError:
+            pass
+        self._proc.kill()
+        self._proc.wait()
+        self._proc = None
@@ -0,0 +1,126 @@
+"""Queue of iTunes commands, run in order by a background worker.
+
+The Alexa request handlers only decide what iTunes should do. The doing,
+which for a big album can take a while, happens here after the reply has
+already gone back to Alexa. While commands wait their turn, redundant ones
+are folded together:
+
+* consecutive skips add up (three "next"s become one skip of 3)
+* play or pause replaces a play or pause still waiting to run
+* a new selection (tracks or playlist) replaces a waiting one, or a waiting play
+* consecutive queue additions are sent as one"""
+
+from collections import deque
+from threading import Thread, Condition, Event
+
+# Handlers that start something new playing
+SELECTIONS = ('play_tracks', 'play_playlist')
+
+class Command:
+    def __init__(self, handler, args, wait=False):
+        self.handler = handler
+        self.args = list(args)
+        # Somebody is waiting on the result, so this can't be merged away
+        self.wait = wait
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+    def __repr__(self):
+        return f"<Command {self.handler}{tuple(self.args)}>"
+
+def coalesce(last, new):
+    """Fold new into last, the command queued before it.
+    Returns the commands to queue in their place."""
+    if last.handler == new.handler == 'skip':
+        count = last.args[0] + new.args[0]
+        return [Command('skip', [count])] if count else []
+
+    if last.handler == new.handler == 'transport':
+        return [new]
+
+    if new.handler in SELECTIONS and \
+       (last.handler in SELECTIONS or last.args == ['play']):
+        return [new]
+
+    if last.handler == new.handler == 'queue_tracks':
+        return [Command('queue_tracks', [last.args[0] + new.args[0]])]
+
+    return [last, new]
+
+class CommandQueue:
+    def __init__(self, execute):
+        self.execute = execute  # called as execute(handler, *args)
+        self.coalesced = 0
+
+        self._pending = deque()
+        self._condition = Condition()
+        self._worker = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, handler, *args, wait=False):
+        """Queue a command, and return it."""
+        command = Command(handler, args, wait)
+        with self._condition:
+            self._start()
+
+            # Only ever merge with the end of the queue, so the order in
+            # which things happen never changes.
+            queued = [command]
+            while not command.wait and self._pending and not self._pending[-1].wait:
+                last = self._pending.pop()
+                queued = coalesce(last, command)
+                if len(queued) == 2:
+                    break
+
+                self.coalesced += 1
+                # Anything merged away counts as done
+                last.done.set()
+                if not queued:
+                    command.done.set()
+                    break
+                command = queued[0]
+                queued = [command]
+
+            self._pending.extend(queued)
+            self._condition.notify()
+
+        return command
+
+    def call(self, handler, *args, timeout=None):
+        """Queue a command and wait for it to run. Returns its result.
+        Raises TimeoutError if it hasn't run within timeout seconds; if it
+        hasn't started by then, it never will."""
+        command = self.put(handler, *args, wait=True)
+        if not command.done.wait(timeout):
+            with self._condition:
+                if command in self._pending:
+                    self._pending.remove(command)
+            raise TimeoutError(f"{command} didn't run within {timeout}s")
+
+        if command.error is not None:
+            raise command.error
+        return command.result
+
+    def _start(self):
+        # Threads don't survive a fork, so check ours is really running.
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = Thread(target=self._run, daemon=True)
+            self._worker.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                command = self._pending.popleft()
+
+            try:
+                command.result = self.execute(command.handler, *command.args)
+            except Exception as e:
+                print(f"Command {command} failed: {e}")
+                command.error = e
+            finally:
+                command.done.set()
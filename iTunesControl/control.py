@@ -1,15 +1,18 @@
 import flask
 import requests
 import subprocess
-from time import sleep
-from . import app, get_tun_url, config, ngrok
-from . import itunes_library, register_public, get_iTunes_lib
+from . import app, get_tun_url, config, save_config, startup_phases
+from . import register_public, get_iTunes_lib, search_index
+from . import start_tunnel, register_in_background
+from .main import player_state, selections, resolved
+from . import metrics
 
 @app.route("/")
 def index():
-    if itunes_library() is not None:
-        num_tracks = len(itunes_library().songs)
-        num_playlists = len(itunes_library().getPlaylistNames())
+    index = search_index()
+    if index is not None:
+        num_tracks = index.num_tracks
+        num_playlists = index.num_playlists
     else:
         num_tracks = "Unknown"
         num_playlists = "Unknown"
@@ -23,6 +26,18 @@ def index():
     }
     return flask.render_template("setup.html", **args)
 
+@app.route("/stats")
+def stats():
+    return flask.jsonify({'nowplaying': player_state.stats(),
+                          'selections': selections.stats(),
+                          'resolved': resolved.stats(),
+                          'startup': startup_phases,})
+
+@app.route("/metrics")
+def prometheus_metrics():
+    return flask.Response(metrics.render(),
+                          content_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.route("/setngrok", methods=["POST"])
 def set_ngrok():
     ngrok_token = flask.request.form.get('authtoken')
@@ -35,16 +50,9 @@ def set_ngrok():
     except subprocess.CalledProcessError:
         return flask.jsonify({'success': False, 'error': 'Unable to register with ngrok',})
 
-    #restart the ngrok tunnel
-    global ngrok
-    ngrok.terminate()
-    ngrok.communicate()  #wait for process to finish
-    ngrok=subprocess.Popen(['./ngrok','http','4380'],stdout=subprocess.DEVNULL)
-
-    # Re-register the new ngrok tunnel endpoint
-    #give the tunnel 3 seconds to establish before checking
-    sleep(3)
-    register_public()
+    #restart the ngrok tunnel, and re-register the new endpoint once it's up
+    start_tunnel()
+    register_in_background()
 
     return flask.jsonify({'success': True,})
 
@@ -56,16 +64,16 @@ def set_iTunes():
 
     #Save the updated variable
     config['iTunes']['xmllocation'] = itunes_lib_path
-    with open('ControlServerConfig.ini', 'w') as configfile:
-        config.write(configfile)
+    save_config()
 
     get_iTunes_lib()
-    if itunes_library() is None:
+    index = search_index()
+    if index is None:
         return flask.jsonify({"success": False, "error": "Unable to load iTunes Library. Check path and that the file exists",})
 
     result = {"success": True,
-              "tracks": len(itunes_library().songs),
-              "playlists": len(itunes_library().getPlaylistNames()),}
+              "tracks": index.num_tracks,
+              "playlists": index.num_playlists,}
 
     return flask.jsonify(result)
 
@@ -81,8 +89,7 @@ def register_endpoint():
                               'error': 'Unable to get public URL',})
     # Save the userid to the config
     config['Alexa']['userid'] = user_id
-    with open('ControlServerConfig.ini', 'w') as configfile:
-        config.write(configfile)
+    save_config()
 
     reg_result = register_public()
     return flask.jsonify(reg_result.json())
\ No newline at end of file
@@ -0,0 +1,161 @@
+"""A lightweight, streaming reader for the iTunes library XML.
+
+libpytunes reads the whole plist into nested dicts and then builds a Song
+object with some forty attributes per track. We only ever use a handful of
+those, so this reads the file incrementally with iterparse, keeps just what
+the intent handlers need, and throws each element away as soon as it has been
+read. It provides the same songs / getPlaylistNames() surface as the
+libpytunes Library."""
+
+import sys
+from array import array
+from xml.etree import ElementTree
+
+# plist key -> Track attribute, for the track fields we keep
+TRACK_FIELDS = {
+    'Track ID': 'track_id',
+    'Name': 'name',
+    'Artist': 'artist',
+    'Album': 'album',
+    'Track Number': 'track_number',
+    'Disc Number': 'disc_number',
+    'Persistent ID': 'persistent_id',
+    'Play Count': 'play_count',
+}
+
+# Fields shared by many tracks, so worth keeping only one copy of each value
+INTERNED_FIELDS = ('artist', 'album')
+
+# Fields that change as the music plays, and that nothing here looks at
+PLAYED_FIELDS = ('play_count', )
+
+class Track:
+    """The parts of an iTunes track the Alexa handlers use"""
+    __slots__ = tuple(TRACK_FIELDS.values())
+
+    def __init__(self):
+        for attr in self.__slots__:
+            setattr(self, attr, None)
+
+    def __repr__(self):
+        return f"<Track {self.track_id}: {self.name} by {self.artist}>"
+
+class Playlist:
+    """A playlist name, with the IDs of the tracks on it in order"""
+    __slots__ = ('name', 'persistent_id', 'track_ids')
+
+    def __init__(self, name=None, persistent_id=None, track_ids=None):
+        self.name = name
+        self.persistent_id = persistent_id
+        self.track_ids = track_ids if track_ids is not None else array('l')
+
+    def __repr__(self):
+        return f"<Playlist {self.name}: {len(self.track_ids)} tracks>"
+
+def _value(element):
+    """Python value of a plist value element"""
+    if element.tag == 'integer':
+        return int(element.text)
+    if element.tag == 'true':
+        return True
+    if element.tag == 'false':
+        return False
+    return element.text
+
+def _pairs(element):
+    """(key, value element) pairs of a plist dict element"""
+    children = list(element)
+    return zip((child.text for child in children[0::2]), children[1::2])
+
+def same_library(old, new):
+    """Whether libraries old and new have the same tracks and playlists, as
+    far as the server is concerned. iTunes rewrites the XML every time a
+    track is played, and most rewrites change nothing but play counts."""
+    fields = [field for field in Track.__slots__ if field not in PLAYED_FIELDS]
+
+    def tracks(library):
+        return {song.track_id: tuple(getattr(song, field) for field in fields)
+                for song in library.songs.values()}
+
+    def playlists(library):
+        return [(playlist.name, playlist.persistent_id, list(playlist.track_ids))
+                for playlist in library.playlists]
+
+    return tracks(old) == tracks(new) and playlists(old) == playlists(new)
+
+class Library:
+    def __init__(self, itunesxml):
+        self.songs = {}
+        self.playlists = []
+        self._load(itunesxml)
+
+    def _load(self, itunesxml):
+        # The elements currently open, from <plist> down.
+        stack = []
+        section = None  # the top level key we are under (Tracks, Playlists)
+        playlist_items = None
+
+        for event, element in ElementTree.iterparse(itunesxml, events=('start', 'end')):
+            if event == 'start':
+                stack.append(element)
+                if len(stack) == 4 and section == 'Playlists':
+                    playlist_items = array('l')
+                continue
+
+            stack.pop()
+            depth = len(stack)
+
+            if depth == 2:
+                if element.tag == 'key':
+                    section = element.text
+                else:
+                    # Done with a top level section
+                    element.clear()
+                    stack[-1].clear()
+            elif depth == 3 and element.tag == 'dict':
+                if section == 'Tracks':
+                    self._add_track(element)
+                elif section == 'Playlists':
+                    self._add_playlist(element, playlist_items)
+                    playlist_items = None
+
+                # Everything in the section up to here has been read
+                stack[-1].clear()
+            elif depth == 5 and element.tag == 'dict' and section == 'Playlists':
+                # An entry in the Playlist Items array of a playlist
+                for key, value in _pairs(element):
+                    if key == 'Track ID':
+                        playlist_items.append(int(value.text))
+                stack[-1].clear()
+
+    def _add_track(self, element):
+        track = Track()
+        for key, value in _pairs(element):
+            attr = TRACK_FIELDS.get(key)
+            if attr is None:
+                continue
+
+            value = _value(value)
+            if attr in INTERNED_FIELDS and value is not None:
+                value = sys.intern(value)
+            setattr(track, attr, value)
+
+        if track.track_id is not None:
+            self.songs[track.track_id] = track
+
+    def _add_playlist(self, element, playlist_items):
+        playlist = Playlist(track_ids=playlist_items)
+        for key, value in _pairs(element):
+            if key == 'Name':
+                playlist.name = _value(value)
+            elif key == 'Playlist Persistent ID':
+                playlist.persistent_id = _value(value)
+
+        if playlist.name is not None:
+            self.playlists.append(playlist)
+
+    def getPlaylistNames(self, ignoreList=[
+        "Library", "Music", "Movies", "TV Shows", "Purchased", "iTunes DJ", "Podcasts"
+    ]):
+        return [playlist.name for playlist in self.playlists
+                if playlist.name not in ignoreList]
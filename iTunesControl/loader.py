@@ -0,0 +1,155 @@
+"""Load the library XML and build its search index in a process of its own.
+
+Parsing and indexing are CPU bound, and in the server process they would
+hold the GIL, and so hold up every request, for as long as they ran. Here
+they run in a separate Python, which hands the result back as a snapshot
+(see snapshot.py). All the server has to do then is unpickle it and swap it
+in.
+
+If the snapshot on disk is of the same file, only what changed since is
+re-indexed, as SearchIndex.updated does in the server. With the sqlite
+backend the library goes into a database instead (see store.py), rebuilt
+whole each time, as it also does alongside the snapshot when several uwsgi
+workers share it. Either way, if nothing the server uses has changed (iTunes
+rewrites the XML for every play count), the snapshot or database is only
+tagged with the new source, and the server is told there is nothing to
+swap in."""
+
+import os
+import sys
+import json
+import types
+import subprocess
+from time import perf_counter
+
+# What run_loader reports
+FAILED, LOADED, UNCHANGED = range(3)
+
+# The loader's exit status when there was nothing new to load
+UNCHANGED_EXIT = 3
+
+# Seconds the loader may run before it is taken to be stuck, and killed.
+# Far more than even a very big library takes.
+LOADER_TIMEOUT = 600
+
+def python_executable():
+    """The Python to run the loader with. Under uwsgi sys.executable is the
+    uwsgi binary (unless py-sys-executable is set), so look for the Python
+    of the environment we're running in instead."""
+    if os.path.basename(sys.executable).startswith('python'):
+        return sys.executable
+
+    version = f"python{sys.version_info.major}.{sys.version_info.minor}"
+    for prefix in (sys.prefix, sys.base_prefix):
+        for name in (version, 'python3', 'python'):
+            path = os.path.join(prefix, 'bin', name)
+            if os.access(path, os.X_OK):
+                return path
+
+    return sys.executable
+
+def run_loader(xml_path, snapshot_path, source, backend='memory', database_path=None,
+               timeout=LOADER_TIMEOUT):
+    """Load xml_path in a child process, into a snapshot (or for the sqlite
+    backend, a database) at snapshot_path tagged with source, and into a
+    database at database_path too if given. LOADED if that worked, UNCHANGED
+    if the tracks and playlists are the same as last time, or FAILED (as it
+    is if the loader takes more than timeout seconds)."""
+    python = python_executable()
+    database = [os.path.abspath(database_path)] if database_path else []
+    try:
+        result = subprocess.run([python, os.path.abspath(__file__),
+                                 xml_path, os.path.abspath(snapshot_path),
+                                 json.dumps(source), backend] + database,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+                                timeout=timeout)
+    except subprocess.TimeoutExpired:
+        # subprocess.run has already killed it
+        print(f"Library loader ({python}) took more than {timeout}s, and was stopped")
+        return FAILED
+
+    output = result.stdout.strip()
+    if result.returncode not in (0, UNCHANGED_EXIT):
+        print(f"Library loader ({python}) failed with exit code {result.returncode}:\n{output}")
+        return FAILED
+
+    if output:
+        print(output)
+    return UNCHANGED if result.returncode == UNCHANGED_EXIT else LOADED
+
+def read_library(xml_path):
+    from iTunesControl.library import Library
+
+    start = perf_counter()
+    library = Library(xml_path)
+    print(f"Loaded {len(library.songs)} tracks in {perf_counter() - start:.2f}s")
+    return library
+
+def build_snapshot(library, xml_path, snapshot_path, source):
+    """True if the library changed, False if only the source did"""
+    from iTunesControl.library import same_library
+    from iTunesControl.search import SearchIndex
+    from iTunesControl.snapshot import save_snapshot, load_snapshot
+
+    # Normalize the catalog once, here, rather than on every request. If we
+    # already have an index for this file, only re-index what changed.
+    start = perf_counter()
+    previous = load_snapshot(snapshot_path, lambda old_source: old_source[0] == xml_path)
+    if previous is not None and same_library(previous[1], library):
+        save_snapshot(snapshot_path, source, library, previous[2])
+        print("No changes to index")
+        return False
+
+    if previous is not None:
+        index = previous[2].updated(previous[1], library)
+    else:
+        index = SearchIndex(library)
+    indexed = perf_counter()
+
+    save_snapshot(snapshot_path, source, library, index)
+    print(f"Indexed in {indexed - start:.2f}s, saved in {perf_counter() - indexed:.2f}s")
+    return True
+
+def build_database(library, xml_path, database_path, source):
+    """True if the library changed, False if only the source did"""
+    from iTunesControl.library import same_library
+    from iTunesControl.store import build_store, open_store, retag_store
+
+    start = perf_counter()
+    previous = open_store(database_path, lambda old_source: old_source[0] == xml_path)
+    if previous is not None and same_library(previous[1], library):
+        retag_store(database_path, source)
+        print("No changes to the database")
+        return False
+
+    build_store(database_path, source, library)
+    print(f"Built the database in {perf_counter() - start:.2f}s")
+    return True
+
+if __name__ == "__main__":
+    # Import the rest of the package without running its __init__, which
+    # starts the whole server. The snapshot's classes still have to come
+    # from iTunesControl.library and .search, for the server to unpickle them.
+    package = types.ModuleType('iTunesControl')
+    package.__path__ = [os.path.dirname(os.path.abspath(__file__))]
+    sys.modules['iTunesControl'] = package
+
+    xml_path, snapshot_path, source, backend = sys.argv[1:5]
+    database_path = sys.argv[5] if len(sys.argv) > 5 else None
+    source = tuple(json.loads(source))
+    try:
+        library = read_library(xml_path)
+        if backend == 'sqlite':
+            changed = build_database(library, xml_path, snapshot_path, source)
+        else:
+            changed = build_snapshot(library, xml_path, snapshot_path, source)
+            if database_path is not None:
+                # For the uwsgi workers to share
+                changed = build_database(library, xml_path, database_path, source) or changed
+    except Exception as e:
+        # Most likely caught iTunes part way through writing the file.
+        print(f"Unable to load iTunes library: {e}")
+        sys.exit(1)
+
+    if not changed:
+        sys.exit(UNCHANGED_EXIT)
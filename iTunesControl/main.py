@@ -1,21 +1,49 @@
+import os
 import flask
-import subprocess
+import shlex
 import json
 import requests
 import hmac
 from urllib.parse import urljoin, urlparse
 from datetime import datetime, timedelta
-
-import re
 from num2words import num2words
-from fuzzywuzzy import fuzz
 
 from . import app, itunes_library, config, get_iTunes_lib, get_tun_url, register_public
+from . import library_state, versioned_library_state, startup_phases
+from .search import normalize_key, sound_match
+from .phonetic import sound_key
+from .scoring import ratio
+from .applescript import ScriptExecutor, ScriptError, JOB_TIMEOUT
+from .player import PlayerState, NowPlaying, Selections
+from .resolved import ResolvedCache
+from .commands import CommandQueue
+from . import metrics
+from .metrics import span
 
 from functools import wraps
 
 intent_handlers = {}
 
+# All AppleScript goes through one long-lived runner process. The runner
+# command can be swapped out (for a stand-in, say) in the config, as can how
+# long a job may take before the runner is restarted.
+script_runner = config['iTunes'].get('scriptrunner')
+executor = ScriptExecutor(shlex.split(script_runner) if script_runner else None,
+                          config['iTunes'].getfloat('scripttimeout', JOB_TIMEOUT))
+
+# The iTunes handlers are compiled once, when the runner starts, and then
+# just called. The runner isn't started here: under uwsgi this runs in the
+# master, and each worker starts its own on its first command.
+with open(os.path.join(os.path.dirname(__file__), 'itunes.applescript')) as script_file:
+    ITUNES_SCRIPT = script_file.read()
+
+executor.register('itunes', ITUNES_SCRIPT)
+
+# play_tracks and queue_tracks search the library once for every track they
+# are given, so they get this many seconds more than other jobs per track
+TRACK_HANDLERS = ('play_tracks', 'queue_tracks')
+TRACK_TIMEOUT = 0.5
+
 def intent(intents):
     if not isinstance(intents, (list, tuple)):
         raise TypeError("Intents must be of list type")
@@ -25,6 +53,9 @@ def intent(intents):
         return func
     return decorator
 
+# What we say if a request comes in before the library has been loaded
+NO_LIBRARY = "I'm still loading your iTunes library. Please try again in a moment."
+
 def sort_fuzzy(item):
     #Use the fuzzy match value, but weigh ones that have exact title matches higher
     if item[2]:
@@ -32,61 +63,15 @@ def sort_fuzzy(item):
     else:
         return item[1]
 
-def normalize_text(text):
-    """Replace any numbers in a string with their textual representation.
-    Note that this may not be desirable. While "Beethoven's 1st symphony" will
-    probably need to be translated to "Beethoven's first symphony" in order to
-    match, "Beethoven's Symphony No. 1" quite possibly might not. Use only as
-    needed."""
-    #Look for odinals (1st, 2nd, 3rd, etc) first
-    ordinals = re.findall('((\d+)(st|nd|rd|th))', text)
-    for entire_result, num_value, _ in ordinals:
-        text = text.replace(entire_result,
-                            num2words(int(num_value), ordinal=True))
-
-    #Now look for any "bare" numbers ("love potion number 9", for example)
-    numbers = re.findall('\d+', text)
-    for num_value in numbers:
-        text = text.replace(num_value, num2words(int(num_value)))
-
-    #Do some basic normalization
-    text = text.replace("-", ' ').replace("$", 's')
-
-    return text
-
-def create_playlist(criteria):
-    script = f"""
-tell application "iTunes"
-    if (exists playlist "Alexa Selections") then
-        delete playlist "Alexa Selections"
-    end if
-    set name of (make new playlist) to "Alexa Selections"
-    set selectedTracks to {criteria}
-
-    -- find highest track number
-    set hi_track_count to 0
-    repeat with a_track in selectedTracks
-            set tk_num to track number of a_track
-            if tk_num > hi_track_count then set hi_track_count to tk_num
-    end repeat
-
-    --add items to playlist in track order.
-    repeat with i from 0 to hi_track_count -- for each number thru hi_track_count...
-        repeat with thisTrack in selectedTracks
-            if track number of thisTrack is i then
-                duplicate thisTrack to playlist "Alexa Selections"
-                exit repeat --no need to look at the rest of the items
-            end if
-        end repeat
-    end repeat
-
-    play playlist "Alexa Selections"
-end tell
-        """
-    return script
+# Requests taking longer than this get logged, stage by stage
+slow_request_seconds = config.getfloat('Server', 'slowrequestms', fallback=1000) / 1000
 
 @app.route("/alexa", methods=["POST"])
 def alexa():
+    with metrics.request_trace(slow_request_seconds) as trace:
+        return handle_alexa(trace)
+
+def handle_alexa(trace):
     """This function fires off all processing for the alexa request. Since,
     theoretically, any random person could hit this server and mess with our
     iTunes, we verify the request signature."""
@@ -94,19 +79,21 @@ def alexa():
     ########################
     ## BEGIN REQUEST VERIFICATION
     ########################
-    # First, generate a signature from the data we received using our shared secret.
-    my_signature = hmac.new(b"6wQ%8cB!mx_zjqXZBm^+pBWW", flask.request.data,
-                            'SHA256').hexdigest().encode('UTF8')
+    with span('signature'):
+        # First, generate a signature from the data we received using our shared secret.
+        my_signature = hmac.new(b"6wQ%8cB!mx_zjqXZBm^+pBWW", flask.request.data,
+                                'SHA256').hexdigest().encode('UTF8')
 
 
-    # Verify that the signature matches the actual content received
-    received_sig = flask.request.headers.get('Signature').encode('ASCII')
-    if not hmac.compare_digest(received_sig, my_signature):
-        flask.abort(400)
+        # Verify that the signature matches the actual content received
+        received_sig = flask.request.headers.get('Signature').encode('ASCII')
+        if not hmac.compare_digest(received_sig, my_signature):
+            flask.abort(400)
 
     # Ok, content came from Amazon alexa. Yay! Let's continue....
     # Since it is from Alexa, it is a JSON formated dataset
-    request = json.loads(flask.request.data)
+    with span('parse'):
+        request = json.loads(flask.request.data)
 
     # Make sure this is coming from *MY* alexa skill
     try:
@@ -137,6 +124,7 @@ def alexa():
     # someone resending the same packets over and over again. Let's actually do
     # something with it!
     request_type = request['request'].get('type', 'unknown')
+    trace['intent'] = request_type
 
     # Set a default response in case we get something confusing.
     result = "I'm sorry, I don't know how to do that"
@@ -150,9 +138,11 @@ def alexa():
         intent_name = intent.get('name')
         print(f"Received {intent_name} intent request")
 
-        try:
-            result = intent_handlers[intent_name](intent)
-        except KeyError as e:
+        if intent_name in intent_handlers:
+            trace['intent'] = intent_name
+            with span('intent'):
+                result = intent_handlers[intent_name](intent)
+        else:
             result = "I don't know how to do that"
     else:
         print(f"Received unknown request type: {request_type}")
@@ -173,68 +163,188 @@ def alexa():
                                   content_type="application/json;charset=UTF-8")
     return response
 
-def run_script(script):
-    print(f"running script:\n{script}")
-    #return "Some Song,Some Artist"
+def execute_script(handler, *args):
+    """Call one of the handlers in itunes.applescript. Runs on the command
+    queue's worker; use run_script or queue_script to get here."""
+    print(f"running script handler {handler}{args}")
+    #return "Some Song\nSome Artist\nplaying"
 
-    proc = subprocess.Popen(['osascript', '-'],
-                            stdin=subprocess.PIPE,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.STDOUT,
-                            universal_newlines=True)
+    timeout = executor.timeout
+    if handler in TRACK_HANDLERS:
+        timeout += TRACK_TIMEOUT * len(args[0])
 
-    stdout_output = proc.communicate(script)[0]
-    return stdout_output
+    try:
+        with span('script'):
+            result = executor.call('itunes', handler, *args, timeout=timeout)
+    except ScriptError:
+        metrics.script_failures_total.inc(handler=handler)
+        raise
+
+    print(f"script finished in {result.elapsed * 1000:.1f}ms")
+    if result.error is not None:
+        print(f"script error: {result.error}")
+        metrics.script_failures_total.inc(handler=handler)
+        return result.error
+
+    return result.output
+
+def track_order(song):
+    """Sort key putting the tracks of an album in the order they play"""
+    return (song.disc_number or 0, song.track_number or 0)
+
+# iTunes commands run in the background, in the order they were given
+command_queue = CommandQueue(execute_script)
+
+# Seconds to wait for iTunes to say what is playing, behind whatever is
+# queued before it, so that Alexa (which gives up after 8) still gets a reply
+NOW_PLAYING_WAIT = 5
+
+# What we have put in the "Alexa Selections" playlist
+selections = Selections()
+
+def run_script(handler, *args, timeout=None):
+    """Run a script handler after anything already queued, and wait for its
+    result (for timeout seconds at most, if given)"""
+    with span('script_wait'):
+        return command_queue.call(handler, *args, timeout=timeout)
+
+def queue_script(handler, *args):
+    """Queue a script handler to run in the background, without waiting"""
+    command_queue.put(handler, *args)
+
+def play_tracks(persistent_ids):
+    """Replace the selections with persistent_ids, and play them"""
+    selections.replace(persistent_ids)
+    queue_script('play_tracks', persistent_ids)
+
+# What recent requests matched in the library (or that they matched nothing)
+resolved = ResolvedCache(config['iTunes'].getint('resolvedcachesize', 256))
+
+def fuzzy_match(item, search, names, kind='other', generation=None, sounds=None):
+    """Match item against one of the SearchIndex's trigram indexes. names
+    maps the normalized keys back to the names as they appear in the library.
+    The closest match is a (name, score, normalized key) tuple, or None if
+    nothing is close enough. kind (album, artist...) labels the lookup in the
+    metrics. Given the generation of the library the index belongs to, the
+    match is remembered in resolved. Given the index's phonetic keys
+    (sounds), a name that sounds right is taken when none is spelled closely
+    enough."""
+    requested_normalized=normalize_key(item)
+
+    if generation is not None:
+        found, result = resolved.get((kind, requested_normalized), generation)
+        if found:
+            metrics.matches_total.inc(kind=kind, result='miss' if result is None else 'hit')
+            return result
+
+    # Only the closest is wanted. If there is a perfect match, that's it.
+    with span('match'):
+        fuzzy_matches=search.match(requested_normalized, 88, limit=1)
+        if not fuzzy_matches and sounds is not None:
+            fuzzy_matches = sound_match(requested_normalized, sounds)
+            if fuzzy_matches:
+                metrics.phonetic_matches_total.inc(kind=kind)
+    metrics.matches_total.inc(kind=kind, result='hit' if fuzzy_matches else 'miss')
+    if not fuzzy_matches:
+        #No fuzzy matches either
+        result = None
+    else:
+        match, key = fuzzy_matches[0]
+        result = (names[key], match, key)
 
-def fuzzy_match(item, options, all_matches=False):
-    fuzzy_matches=[]
-    requested_normalized=normalize_text(item.lower())
+    if generation is not None:
+        resolved.set((kind, requested_normalized), generation, result)
+    return result
 
-    for option in options:
-        normalized_name=normalize_text(option.lower())
+def find_song(song_title, song_artist=None):
+    """Find the library track best matching the (normalized) title and,
+    optionally, artist. Returns None if nothing is close enough."""
+    library, index, generation = versioned_library_state()
+    key = ('song', song_title, song_artist)
+    found, song = resolved.get(key, generation)
+    if not found:
+        with span('match'):
+            song = _find_song(library, index, song_title, song_artist)
+        resolved.set(key, generation, song)
+    metrics.matches_total.inc(kind='song', result='miss' if song is None else 'hit')
+    return song
+
+def _find_song(library, index, song_title, song_artist):
+    fuzzy_matches = []
+    # Anything with a title_match less than 89 is not close enough to consider
+    for title_match, normalized_name in index.title_search.match(song_title, 89):
+        track_ids = index.titles[normalized_name]
+
+        # if title_match is less than 100 but greater than 89, we'll consider it *only* if we don't find an exact match.
+        if title_match < 100:
+            #save for potential futue consideration
+            fuzzy_matches.extend((library.songs[track_id], title_match, False)
+                                 for track_id in track_ids)
+            continue  #and move on
+
+        # If we get here,the title matches exactly.
+        for track_id in track_ids:
+            # If an artist was provided as well, we need to see if it also matches.
+            if song_artist:
+                # Artist for this song might be none
+                normalized_artist = index.track_artists[track_id]
+                if not normalized_artist:
+                    continue  #this song has no artist listed, so can't match
 
-        match=fuzz.ratio(normalized_name,requested_normalized)
-        if match==100:
-            #If we found a perfect match, just return it
-            if not all_matches:
-                return (option,100)
-            else:
-                fuzzy_matches.append((option,match))
-                continue
-        if match>=88:
-            fuzzy_matches.append((option,match))
-            continue
-    else:
-        #No exact match found, or all matches wanted
-        if not fuzzy_matches:
-            #No fuzzy matches either
-            return None
-        else:
-            if all_matches:
-                return fuzzy_matches
+                artist_match = ratio(normalized_artist, song_artist)
+                if artist_match < 89:
+                    continue
+                if artist_match < 100:
+                    fuzzy_matches.append((library.songs[track_id], artist_match, True))
+                    continue
 
-            # sort the fuzzy matches by closeness, and return the closest
-            fuzzy_match=sorted(fuzzy_matches,key=lambda x:x[1]).pop(0)
-            return fuzzy_match
+            # if we hit this point, then we have matched both title and (if desired) artist.
+            return library.songs[track_id]
+
+    # We get here, it means we found no exact match.
+    # Take a fuzzy match (if any)
+    if fuzzy_matches:
+        # Take the "closest" match
+        return max(fuzzy_matches, key=sort_fuzzy)[0]
+
+    # Nothing is spelled closely enough, but something may sound right
+    song = _find_song_by_sound(library, index, song_title, song_artist)
+    if song is not None:
+        metrics.phonetic_matches_total.inc(kind='song')
+    return song
+
+def _find_song_by_sound(library, index, song_title, song_artist):
+    for _, normalized_name in sound_match(song_title, index.title_sounds):
+        for track_id in index.titles[normalized_name]:
+            if song_artist:
+                normalized_artist = index.track_artists[track_id]
+                if not normalized_artist:
+                    continue
+                if ratio(normalized_artist, song_artist) < 89 and \
+                   sound_key(normalized_artist) != sound_key(song_artist):
+                    continue
+
+            return library.songs[track_id]
+
+    return None
 
 @intent(['PlayPlaylist'])
 def play_playlist(intent_data):
     requested=intent_data.get('slots', {}).get('playlist',{}).get('value').lower()
 
-    if itunes_library():  # if we don't have the library available, we just try it.
-        playlists = itunes_library().getPlaylistNames()
-
+    _, index, generation = versioned_library_state()
+    if index:  # if we don't have the library available, we just try it.
         # A playlist of "Library is valid, though not listed"
         if requested != "library":
-            match=fuzzy_match(requested,playlists)
+            match=fuzzy_match(requested,index.playlist_search,index.playlist_names,
+                              kind='playlist', generation=generation)
             if match is None:
                 return f"I can't find any playlists named {requested}"
             else:
                 requested=match[0]
 
-    script = f"""tell application "iTunes" to play playlist "{requested}" """
-
-    result = run_script(script)
+    queue_script('play_playlist', requested)
+    player_state.invalidate()
     return f"Playing playlist {requested}"
 
 @intent(['PlaySong'])
@@ -245,196 +355,175 @@ def play_song(intent_data):
     if not song_title:
         # if we don't have a title, treat this as a bare "play" request, even if
         # we have an artist
-        script = """tell application "iTunes" to play"""
-    else:
-        # Find the cannonical name of the track in the library. Gives the FIRST match.
-
-        # this gives a syntax error if I take the space out at the end,
-        # so strip it off after the fact.
-        script = """{{item 1}} of (every file track of playlist "Library" whose name is "{title}" """.strip()
-
-        song_title = normalize_text(song_title.lower())
-        if song_artist:
-            song_artist = normalize_text(song_artist.lower())
+        queue_script('transport', 'play')
+        player_state.invalidate()
+        return whats_playing("_")
 
-        # Find a match in the library
-        fuzzy_matches = []
-        for song in itunes_library().songs.values():
-            normalized_name = normalize_text(song.name.lower())
+    if library_state()[1] is None:
+        return NO_LIBRARY
 
-            title_match = fuzz.ratio(normalized_name, song_title)
-            # if title_match is less than 89, not close enough to consider
-            if  title_match< 89:
-                continue  #name of track is different, so move on
+    normalized_title = normalize_key(song_title)
+    normalized_artist = normalize_key(song_artist) if song_artist else None
 
-            # if title_match is less than 100 but greater than 89, we'll consider it *only* if we don't find an exact match.
-            if title_match < 100:
-                #save for potential futue consideration
-                fuzzy_matches.append((song, title_match, False))
-                continue  #and move on
-
-            # If we get here,the title matches exactly.
-            # If an artist was provided as well, we need to see if it also matches.
-            if song_artist:
-                # Artist for this song might be none
-                normalized_artist = normalize_text(song.artist.lower()) if song.artist else None
-                if not normalized_artist:
-                    continue  #this song has no artist listed, so can't match
-
-                artist_match = fuzz.ratio(normalized_artist, song_artist)
-                if artist_match < 89:
-                    continue
-                if artist_match < 100:
-                    fuzzy_matches.append((song, artist_match, True))
-                    continue
-
-            # if we hit this point, then we have matched both title and (if desired) artist.
-            # this is the track we want, so set our search values to the cannonical name/artist and stop looking.
-            song_title = song.name
-            if song_artist:
-                song_artist = song.artist
-            break
-
-        else:  # We get here, it means we found no exact match.
-            # Take a fuzzy match (if any)
-            if fuzzy_matches:
-                # Take the "closest" match
-                print("*******", fuzzy_matches)
-                song = sorted(fuzzy_matches, key=sort_fuzzy)[-1][0]
-
-                # if we hit this point, then we have a fuzzy match and (if desired) artist.
-                # this is the track we want, so set our search values to the cannonical name/artist and stop looking.
-                song_title = song.name
-                if song_artist:
-                    song_artist = song.artist
-
-            else:  # We get here, it means we found no match.
-                return_str = f"I can't find a song named {song_title}"
-                if song_artist:
-                    return_str += f" by {song_artist}"
-                return return_str
-
-        # We now have the canonical name/artist from the library,
-        # so populate the script.
-        script = script.format(title=song_title)
+    # Find a match in the library
+    song = find_song(normalized_title, normalized_artist)
+    if song is None:
+        return_str = f"I can't find a song named {song_title}"
         if song_artist:
-            script += f""" and artist is "{song_artist}" """
-        script = create_playlist(script+")")
+            return_str += f" by {song_artist}"
+        return return_str
 
-    try:
-        run_script(script)
-    except:
-        error = f"Unable to find song {song_title}"
-        if song_artist:
-            error += f" by {song_artist}"
-        return error
+    # We now have the exact track from the library, so play it by its
+    # persistent ID rather than searching for it all over again by name.
+    play_tracks([song.persistent_id])
 
+    # We know what iTunes is playing now, no need to ask it.
+    player_state.set(NowPlaying(song.name, song.artist, 'playing'))
     return whats_playing("_")
 
 
 @intent(['PlayAlbum'])
 def play_album(intent_data):
     album_name=intent_data.get('slots', {}).get('album',{}).get('value')
-    match=fuzzy_match(album_name,
-                      {song.album for song in itunes_library().songs.values() if song.album is not None})
+    library, index, generation = versioned_library_state()
+    if index is None:
+        return NO_LIBRARY
+    match=fuzzy_match(album_name, index.album_search, index.album_names, kind='album',
+                      generation=generation, sounds=index.album_sounds)
     if match is None:
         return f"I can't find any albums named {album_name}"
     else:
         album_name=match[0]
 
-    script = create_playlist(f"""every track of playlist "Library" whose album is "{album_name}" """)
+    # Put the album in order here, and hand iTunes the finished list
+    songs = sorted((library.songs[track_id] for track_id in index.albums[match[2]]),
+                   key=track_order)
 
-    result = run_script(script)
+    play_tracks([song.persistent_id for song in songs if song.persistent_id])
+    if songs:
+        player_state.set(NowPlaying(songs[0].name, songs[0].artist, 'playing'))
     return f"Playing album {album_name}"
 
+@intent(['PlayArtist'])
+def play_artist(intent_data):
+    artist_name=intent_data.get('slots', {}).get('artist',{}).get('value')
+    if not artist_name:
+        return "I didn't catch which artist to play"
+
+    library, index, generation = versioned_library_state()
+    if index is None:
+        return NO_LIBRARY
+    match=fuzzy_match(artist_name, index.artist_search, index.artist_names, kind='artist',
+                      generation=generation, sounds=index.artist_sounds)
+    if match is None:
+        return f"I can't find any songs by {artist_name}"
+    else:
+        artist_name=match[0]
+
+    # Album by album, each in track order
+    songs = sorted((library.songs[track_id] for track_id in index.artists[match[2]]),
+                   key=lambda song: (song.album or '', track_order(song)))
+
+    play_tracks([song.persistent_id for song in songs if song.persistent_id])
+    if songs:
+        player_state.set(NowPlaying(songs[0].name, songs[0].artist, 'playing'))
+    return f"Playing songs by {artist_name}"
+
 @intent(['AMAZON.StopIntent', 'AMAZON.PauseIntent'])
 def stop_playback(_):
-    script = """tell application "iTunes" to pause"""
-    run_script(script)
+    queue_script('transport', 'pause')
+    player_state.invalidate()
     return "OK"
 
 @intent(['AMAZON.NextIntent'])
 def next_track(_):
-    script = """tell application "iTunes" to play next track """
-
-    run_script(script)
+    queue_script('skip', 1)
+    player_state.invalidate()
     return "OK"
 
 @intent(['AMAZON.PreviousIntent'])
 def previous_track(_):
-    script = """tell application "iTunes" to play previous track """
-
-    run_script(script)
+    queue_script('skip', -1)
+    player_state.invalidate()
     return "OK"
 
 @intent(["QueueSong"])
 def queue_song(intent_data):
-    return "I'm sorry, but I can't do that yet"
-
     song_title=intent_data.get('slots', {}).get('title',{}).get('value')
     song_artist=intent_data.get('slots', {}).get('artist',{}).get('value')
 
-    artist_matches=[] #default
-    title_matches=fuzzy_match(song_title,
-                              (song.name for song in itunes_library().songs.values()),
-                              all_matches=True)
-    print(title_matches)
-    if title_matches and song_artist:
-        artist_matches=fuzzy_match(song_artist,
-                                  (song.artist for song in itunes_library().songs.values() if song.artist is not None and song.name in (x[0] for x in title_matches)))
+    if not song_title:
+        return "I didn't catch which song to add"
+
+    if library_state()[1] is None:
+        return NO_LIBRARY
 
-    if (not song_artist and not title_matches) or (song_artist and not artist_matches):
+    song=find_song(normalize_key(song_title),
+                   normalize_key(song_artist) if song_artist else None)
+
+    if song is None:
         result=f"I can't find any songs named {song_title}"
         if song_artist:
             result+=f" by {song_artist}"
         return result
 
-    if song_artist and artist_matches:
-        song=next((song for song in itunes_library().songs.values() if song.name in (title[0] for title in title_matches) and song.artist==artist_matches[0]))
-
-        script="""tell application "iTunes"
-	repeat with thisTrack in {{item 1}} of (every file track of playlist "Library" whose name is "{title}" and artist is "{artist}")
-		duplicate thisTrack to playlist "Alexa Selections"
-	end repeat
-        play
-end tell
-        """
-        script=script.format(title=song.name, artist=song.artist)
+    if song_artist:
         result=f"Added {song.name} by {song.artist}"
     else:
-        song=next((song for song in itunes_library().songs.values() if song.name in (title[0] for title in title_matches)))
-
-        script="""tell application "iTunes"
-            repeat with thisTrack in {{item 1}} of (every file track of playlist "Library" whose name is "{title}")
-                    duplicate thisTrack to playlist "Alexa Selections"
-            end repeat
-            play
-    end tell
-            """
-        script=script.format(title=song.name)
         result=f"Added {song.name}"
 
-    run_script(script)
-    return result
+    # Just the one track goes on the end of the playlist, however long it is
+    position = selections.append([song.persistent_id])
+    queue_script('queue_tracks', [song.persistent_id])
+    return f"{result}, {num2words(position, ordinal=True)} in the queue"
 
-@intent(['WhatsPlaying'])
-def whats_playing(_):
+def fetch_now_playing():
     #Get the currently playing song/artist from iTunes
-    script = """tell application "iTunes"
-        set track_artist to the artist of the current track
-        set track_title to the name of the current track
-        log track_title & "," & track_artist
-    end tell
-    """
-    result = run_script(script)
-
-    song_title = song_artist = None
     try:
-        song_title, song_artist = result.strip().split(",")
-    except:
-        if not song_title:
-            song_title = "Unknown Song"
-        if not song_artist:
-            song_artist = "Unknown Artist"
+        result = run_script('now_playing', timeout=NOW_PLAYING_WAIT)
+    except (ScriptError, TimeoutError) as e:
+        print(e)
+        return NowPlaying()
+
+    try:
+        song_title, song_artist, state = result.rstrip('\n').split('\n')
+    except ValueError:
+        return NowPlaying()
+
+    return NowPlaying(song_title or None, song_artist or None, state)
+
+# What iTunes is playing, re-checked at most every few seconds
+player_state = PlayerState(fetch_now_playing,
+                           ttl=config['iTunes'].getfloat('nowplayingttl', 5))
+
+metrics.Collected('itunescontrol_nowplaying_cache_hits_total',
+                  "Now playing lookups answered from the cache",
+                  lambda: player_state.hits, kind='counter')
+metrics.Collected('itunescontrol_nowplaying_cache_misses_total',
+                  "Now playing lookups that had to ask iTunes",
+                  lambda: player_state.misses, kind='counter')
+metrics.Collected('itunescontrol_command_queue_length',
+                  "iTunes commands waiting to run", lambda: len(command_queue))
+metrics.Collected('itunescontrol_commands_coalesced_total',
+                  "iTunes commands merged into another before running",
+                  lambda: command_queue.coalesced, kind='counter')
+metrics.Collected('itunescontrol_selections_tracks',
+                  "Tracks in the Alexa Selections playlist", lambda: len(selections))
+metrics.Collected('itunescontrol_resolved_cache_hits_total',
+                  "Requests answered from the cache of what they matched before",
+                  lambda: resolved.hits, kind='counter')
+metrics.Collected('itunescontrol_resolved_cache_misses_total',
+                  "Requests that had to be matched against the library",
+                  lambda: resolved.misses, kind='counter')
+metrics.Collected('itunescontrol_startup_seconds',
+                  "Seconds from the start of startup to reaching each phase of it",
+                  lambda: startup_phases, label='phase')
+
+@intent(['WhatsPlaying'])
+def whats_playing(_):
+    with span('whats_playing'):
+        current = player_state.get()
 
+    song_title = current.title or "Unknown Song"
+    song_artist = current.artist or "Unknown Artist"
     return f"Playing {song_title} by {song_artist}"
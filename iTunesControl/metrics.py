@@ -0,0 +1,171 @@
+"""Counters and latency histograms, served in the Prometheus text format by
+the /metrics route.
+
+Work is timed with span(stage), which records into the stage histogram and,
+when called while handling an Alexa request, into that request's trace. A
+request that takes longer than the slow request threshold is logged with the
+time spent in each stage.
+
+Each uwsgi worker keeps its own metrics, and reports them labelled with its
+worker id: a scrape is answered by whichever worker takes it, so they are
+added up (or graphed per worker) by the one doing the scraping."""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock, local
+from time import perf_counter
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+# Upper bounds, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Everything /metrics reports, in the order it reports it
+registry = []
+
+def label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = Lock()
+        registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in sorted(values.items()):
+            yield self.name, labels, value
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._values = {}  # labels -> [count per bucket..., overflow, sum]
+        self._lock = Lock()
+        registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * (len(self.buckets) + 2)
+            # Counted in the first bucket that holds the value, and made
+            # cumulative when reported
+            values[bisect_left(self.buckets, value)] += 1
+            values[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = {key: list(counts) for key, counts in self._values.items()}
+        for labels, counts in sorted(values.items()):
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                yield f"{self.name}_bucket", labels + (('le', bound), ), total
+            total += counts[-2]
+            yield f"{self.name}_bucket", labels + (('le', '+Inf'), ), total
+            yield f"{self.name}_sum", labels, counts[-1]
+            yield f"{self.name}_count", labels, total
+
+class Collected:
+    """A value kept somewhere else (the now playing cache, say), read when
+    the metrics are. With a label, read returns a dict of label value ->
+    value."""
+    def __init__(self, name, help, read, kind='gauge', label=None):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.kind = kind
+        self.label = label
+        registry.append(self)
+
+    def samples(self):
+        if self.label is None:
+            yield self.name, (), self.read()
+            return
+
+        for label_value, value in list(self.read().items()):
+            yield self.name, ((self.label, label_value), ), value
+
+def render():
+    """All the metrics, in the Prometheus text format"""
+    worker = (('worker', uwsgi.worker_id()), ) if uwsgi is not None else ()
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{label_text(worker + labels)} {value}")
+    return '\n'.join(lines) + '\n'
+
+requests_total = Counter('itunescontrol_requests_total',
+                         "Alexa requests handled, by intent and response status")
+request_seconds = Histogram('itunescontrol_request_seconds',
+                            "Time to answer an Alexa request, by intent")
+stage_seconds = Histogram('itunescontrol_stage_seconds',
+                          "Time spent in each stage of the work")
+matches_total = Counter('itunescontrol_matches_total',
+                        "Library lookups, by what was looked up and whether it was found")
+phonetic_matches_total = Counter('itunescontrol_phonetic_matches_total',
+                                 "Library lookups only found by how the name sounds")
+script_failures_total = Counter('itunescontrol_script_failures_total',
+                                "AppleScript handlers that returned an error or failed to run")
+
+# Stage timings for the request being handled by this thread
+_trace = local()
+
+@contextmanager
+def span(stage):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = perf_counter() - start
+        stage_seconds.observe(elapsed, stage=stage)
+        stages = getattr(_trace, 'stages', None)
+        if stages is not None:
+            stages.append((stage, elapsed))
+
+@contextmanager
+def request_trace(slow_threshold):
+    """Trace the spans of one request. The yielded dict's 'intent' and
+    'status' label what the request turned out to be."""
+    _trace.stages = []
+    request = {'intent': 'unknown', 'status': 200}
+    start = perf_counter()
+    try:
+        yield request
+    except Exception as e:
+        # flask.abort and friends carry their status
+        request['status'] = getattr(e, 'code', 500)
+        raise
+    finally:
+        elapsed = perf_counter() - start
+        stages = _trace.stages
+        _trace.stages = None
+
+        request_seconds.observe(elapsed, intent=request['intent'])
+        requests_total.inc(intent=request['intent'], status=request['status'])
+        if elapsed >= slow_threshold:
+            breakdown = ', '.join(f"{stage} {seconds * 1000:.1f}ms" for stage, seconds in stages)
+            print(f"Slow request: {request['intent']} took {elapsed * 1000:.1f}ms ({breakdown})")
@@ -0,0 +1,143 @@
+"""Phonetic keys, for names Alexa heard right but spelled wrong.
+
+Speech recognition gets the sound of a name right far more often than the
+spelling: "Fill Collins", "Air O Smith", "Nite Fever". Those can be too far
+from the real name for fuzz.ratio to accept, so the search index also keeps
+every name under its phonetic key, and a request that matches nothing
+closely enough is looked up by its key instead.
+
+The key is a cut down Metaphone: the words are run together and reduced to
+their consonant sounds, with the letters that can make the same sound
+(c/k/q, s/z, f/ph/v, b/p, d/t...) mapped to one code, silent letters
+dropped, and only the very first vowel kept. So names that sound alike get
+the same key, however they are split into words."""
+
+import re
+import unicodedata
+
+VOWELS = set('aeiou')
+FRONT_VOWELS = set('eiy')
+
+WORD_RE = re.compile(r"[a-z]+")
+VOWEL_RUN_RE = re.compile(r"[aeiouy]+")
+# The e of "live", "nite", "ate", but not of "beyonce" or "me"
+SILENT_E_RE = re.compile(r"[aeiouy][^aeiouy]e$")
+
+# Silent first letters
+SILENT_STARTS = ('kn', 'gn', 'pn', 'wr', 'ps')
+
+# Letters that always have the same code, wherever they are
+SIMPLE_CODES = {'b': 'p', 'f': 'f', 'j': 'j', 'l': 'l', 'm': 'm', 'n': 'n',
+                'q': 'k', 'r': 'r', 'v': 'f', 'z': 's'}
+
+def plain_words(text):
+    """The words of text, lower cased and with any accents taken off, since
+    "Beyoncé" sounds like "beyonce" and not like "beyonc" """
+    text = unicodedata.normalize('NFKD', text.lower())
+    return WORD_RE.findall(''.join(c for c in text if not unicodedata.combining(c)))
+
+def spoken(word):
+    """One lower case word, spelled the way it starts out sounding"""
+    if word.startswith(SILENT_STARTS):
+        return word[1:]
+    if word.startswith('x'):
+        return 's' + word[1:]
+    if word.startswith('wh'):
+        return 'w' + word[2:]
+    return word
+
+def letters_key(word):
+    """The phonetic key of a run of lower case letters"""
+    codes = []
+    length = len(word)
+    for i, letter in enumerate(word):
+        before = word[i - 1] if i else ''
+        after = word[i + 1] if i + 1 < length else ''
+        # Doubled letters sound like one, except for the c in "acc", or
+        # where the second starts a th, sh... (of the next word, usually)
+        if letter == before and letter != 'c' and after != 'h':
+            continue
+
+        if letter in VOWELS:
+            if i == 0:
+                codes.append('a')
+        elif letter in SIMPLE_CODES:
+            # The b in a final "mb" (lamb, tomb) is silent
+            if letter == 'b' and before == 'm' and not after:
+                continue
+            codes.append(SIMPLE_CODES[letter])
+        elif letter == 'c':
+            if after == 'h' and (before == 's' or word[i + 2:i + 3] in ('r', 'l')):
+                codes.append('k')  # school, christmas, chloe
+            elif after == 'h' or word[i:i + 3] == 'cia':
+                codes.append('x')
+            elif after in FRONT_VOWELS:
+                codes.append('s')
+            else:
+                codes.append('k')
+        elif letter == 'd':
+            if after == 'g' and word[i + 2:i + 3] in FRONT_VOWELS:
+                codes.append('j')
+            else:
+                codes.append('t')
+        elif letter == 'g':
+            if after == 'h' and word[i + 2:i + 3] not in VOWELS:
+                continue  # night, though
+            if after == 'n' and word[i + 2:] in ('', 's'):
+                continue  # sign, signs
+            if before == 'd' and after in FRONT_VOWELS:
+                continue  # already the j of "dge"
+            codes.append('j' if after in FRONT_VOWELS else 'k')
+        elif letter == 'h':
+            # Only sounded at the very start, or between vowels
+            if after in VOWELS and (i == 0 or before in VOWELS):
+                codes.append('h')
+        elif letter == 'k':
+            if before != 'c':
+                codes.append('k')
+        elif letter == 'p':
+            codes.append('f' if after == 'h' else 'p')
+        elif letter == 's':
+            if after == 'h' or word[i:i + 3] in ('sio', 'sia'):
+                codes.append('x')
+            else:
+                codes.append('s')
+        elif letter == 't':
+            if word[i:i + 3] in ('tio', 'tia'):
+                codes.append('x')
+            elif after == 'h':
+                codes.append('0')
+            elif word[i:i + 3] != 'tch':
+                codes.append('t')
+        elif letter in 'wy':
+            # The w of "kw" is already part of the sound of a q
+            if after in VOWELS and not (letter == 'w' and before in ('k', 'q')):
+                codes.append(letter)
+        elif letter == 'x':
+            codes.append('ks')
+
+    # The same sound twice running (the "ck" of "back", "ds" of "adds"...)
+    # is one sound
+    key = []
+    for code in codes:
+        if not key or key[-1] != code:
+            key.append(code)
+    return ''.join(key)
+
+def sound_key(text):
+    """The phonetic key of some (normalized) text. The words are run
+    together and keyed as one, since speech recognition often splits them
+    differently ("fleet wood mac", "air o smith")."""
+    return letters_key(''.join(spoken(word) for word in plain_words(text)))
+
+def syllables(text):
+    """Roughly how many syllables some (normalized) text has: the runs of
+    vowels in each word, less a silent final e. Unlike the spelling, this
+    is something a misheard name usually gets right."""
+    count = 0
+    for word in plain_words(text):
+        runs = len(VOWEL_RUN_RE.findall(word))
+        if runs > 1 and SILENT_E_RE.search(word):
+            runs -= 1
+        count += runs
+    return count
@@ -0,0 +1,93 @@
+from threading import Lock
+from time import monotonic
+
+class NowPlaying:
+    """What iTunes is playing, as of the last time we asked (or told it)"""
+    def __init__(self, title=None, artist=None, state=None):
+        self.title = title
+        self.artist = artist
+        self.state = state  # playing, paused, stopped...
+
+    def __repr__(self):
+        return f"<NowPlaying {self.title} by {self.artist} ({self.state})>"
+
+class PlayerState:
+    """Cache of the iTunes player state.
+
+    Asking iTunes what it is playing is a round trip through AppleScript, so
+    the answer is kept for ttl seconds. Our own commands either tell the cache
+    what iTunes will be doing (set) or throw the cached answer away
+    (invalidate), so the cache never reports a track we have moved off of."""
+
+    def __init__(self, fetch, ttl=5):
+        self.fetch = fetch  # callable returning a NowPlaying
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+
+        self._current = None
+        self._expires = 0
+        # bumped by every set/invalidate, so a fetch that was already under
+        # way when we changed the player doesn't overwrite what we know.
+        self._generation = 0
+        self._lock = Lock()
+
+    def get(self):
+        with self._lock:
+            if self._current is not None and monotonic() < self._expires:
+                self.hits += 1
+                return self._current
+            self.misses += 1
+            generation = self._generation
+
+        current = self.fetch()
+        with self._lock:
+            if generation == self._generation:
+                self._store(current)
+        return current
+
+    def _store(self, current):
+        self._current = current
+        self._expires = monotonic() + self.ttl
+        self._generation += 1
+
+    def set(self, current):
+        with self._lock:
+            self._store(current)
+
+    def invalidate(self):
+        with self._lock:
+            self._current = None
+            self._generation += 1
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'ttl': self.ttl}
+
+class Selections:
+    """The tracks in the "Alexa Selections" playlist, in order, as we last
+    left it, so that queueing a track can say where in the queue it went
+    without asking iTunes what's already there. Only changes made through
+    this process are seen here."""
+
+    def __init__(self):
+        self.persistent_ids = []
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self.persistent_ids)
+
+    def replace(self, persistent_ids):
+        """The playlist has been rebuilt with just persistent_ids"""
+        with self._lock:
+            self.persistent_ids = list(persistent_ids)
+
+    def append(self, persistent_ids):
+        """persistent_ids have been added to the end. Returns how many
+        tracks the playlist now has."""
+        with self._lock:
+            self.persistent_ids.extend(persistent_ids)
+            return len(self.persistent_ids)
+
+    def stats(self):
+        return {'tracks': len(self.persistent_ids)}
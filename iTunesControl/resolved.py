@@ -0,0 +1,49 @@
+from collections import OrderedDict
+from threading import Lock
+
+class ResolvedCache:
+    """Least recently used cache of what requests resolved to.
+
+    People ask for the same few songs, albums and playlists over and over,
+    so what each (kind, normalized request) matched in the library, or that
+    it matched nothing, is kept here rather than worked out again. Every
+    entry is tagged with the generation of the library it was found in, and
+    is only ever served for that generation, so a reloaded library is never
+    answered from the old one."""
+
+    def __init__(self, size=256):
+        self.size = size
+
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()  # key -> (generation, value)
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, generation):
+        """(True, value) if key was resolved in generation, or (False, None)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == generation:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+
+            self.misses += 1
+            return False, None
+
+    def set(self, key, generation, value):
+        with self._lock:
+            self._entries[key] = (generation, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'size': self.size,
+                'entries': len(self._entries),
+                'hit_rate': self.hits / lookups if lookups else None}
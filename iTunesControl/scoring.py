@@ -0,0 +1,35 @@
+"""Scoring a query against a whole list of keys in one call.
+
+fuzz.ratio scores one pair per call, from a Python loop. With rapidfuzz
+installed, extract() hands it the whole list at once instead, to be scored
+in C. rapidfuzz's ratio is the same edit distance score fuzzywuzzy gives
+with python-Levenshtein, rounded the same way here, so the matches don't
+change; bench/scoring_parity.py checks that they don't. Without rapidfuzz
+this falls back to fuzzywuzzy, one pair at a time."""
+
+try:
+    from rapidfuzz import fuzz as rapid_fuzz, process
+except ImportError:
+    rapid_fuzz = None
+    from fuzzywuzzy import fuzz
+
+def ratio(a, b):
+    """fuzz.ratio(a, b)"""
+    if rapid_fuzz is None:
+        return fuzz.ratio(a, b)
+    return int(round(rapid_fuzz.ratio(a, b)))
+
+def extract(query, keys, threshold):
+    """(score, key) for each of keys with a fuzz.ratio of at least threshold
+    against query, in no particular order"""
+    if rapid_fuzz is None:
+        scored = ((fuzz.ratio(key, query), key) for key in keys)
+        return [match for match in scored if match[0] >= threshold]
+
+    # Anything that could round up to the threshold
+    cutoff = threshold - 0.5
+    scored = ((int(round(score)), key) for key, score, _ in process.extract(
+        query, list(keys), scorer=rapid_fuzz.ratio, processor=None,
+        score_cutoff=cutoff, limit=None))
+
+    return [match for match in scored if match[0] >= threshold]
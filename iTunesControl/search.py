@@ -0,0 +1,429 @@
+import re
+import copy
+import heapq
+from collections import Counter
+from num2words import num2words
+
+from .scoring import extract, ratio
+from .phonetic import sound_key, syllables
+
+ORDINAL_RE = re.compile(r'((\d+)(st|nd|rd|th))')
+NUMBER_RE = re.compile(r'\d+')
+
+# Playlists iTunes creates on its own. These are never offered as matches.
+IGNORED_PLAYLISTS = ("Library", "Music", "Movies", "TV Shows", "Purchased",
+                     "iTunes DJ", "Podcasts")
+
+def normalize_text(text):
+    """Replace any numbers in a string with their textual representation.
+    Note that this may not be desirable. While "Beethoven's 1st symphony" will
+    probably need to be translated to "Beethoven's first symphony" in order to
+    match, "Beethoven's Symphony No. 1" quite possibly might not. Use only as
+    needed."""
+    #Look for odinals (1st, 2nd, 3rd, etc) first
+    ordinals = ORDINAL_RE.findall(text)
+    for entire_result, num_value, _ in ordinals:
+        text = text.replace(entire_result,
+                            num2words(int(num_value), ordinal=True))
+
+    #Now look for any "bare" numbers ("love potion number 9", for example)
+    numbers = NUMBER_RE.findall(text)
+    for num_value in numbers:
+        text = text.replace(num_value, num2words(int(num_value)))
+
+    #Do some basic normalization
+    text = text.replace("-", ' ').replace("$", 's')
+
+    return text
+
+# How many of the best scoring matches a search hands back by default
+MATCH_LIMIT = 5
+
+# Phonetic keys shorter than this say too little about a name to match on
+MIN_SOUND_KEY = 3
+# A name with the same phonetic key still has to have about as many
+# syllables as the request, or "live mead" would play "Love Me Do": one
+# more or fewer for every this many
+SYLLABLE_SLACK = 4
+
+def normalize_key(text):
+    """Lower case and normalize a library or slot value for matching"""
+    return normalize_text(text.lower())
+
+class SearchIndex:
+    """Normalized lookup keys for a loaded library.
+
+    Built once when the library is loaded, so that the intent handlers never
+    have to normalize the catalog themselves. Each of the key maps goes from a
+    normalized name to the list of track IDs carrying that name.
+
+    An index is never modified once it is in use. When the library changes,
+    updated() produces a new index sharing everything that did not change."""
+
+    def __init__(self, library):
+        self.titles = {}
+        self.artists = {}
+        self.albums = {}
+        self.playlists = {}
+
+        # normalized artist for each track, for title+artist matching
+        self.track_artists = {}
+
+        # normalized name -> name as it appears in the library
+        self.artist_names = {}
+        self.album_names = {}
+        self.playlist_names = {}
+
+        # playlist persistent ID -> (name, track IDs), to tell what changed
+        self.playlist_contents = {}
+        # playlist name -> normalized name
+        self.playlist_keys = {}
+
+        self.title_search = TrigramIndex()
+        self.artist_search = TrigramIndex()
+        self.album_search = TrigramIndex()
+        self.playlist_search = TrigramIndex()
+
+        # phonetic key -> the normalized keys that sound like it, for when
+        # nothing is spelled closely enough (see phonetic.py)
+        self.title_sounds = {}
+        self.artist_sounds = {}
+        self.album_sounds = {}
+
+        # track ID lists copied from the index this one was updated from.
+        # None means everything belongs to this index.
+        self._copied = None
+
+        for track_id, song in library.songs.items():
+            self._add_track(track_id, song)
+
+        self._update_playlists(library)
+
+    def updated(self, old_library, library):
+        """Return a copy of this index with the differences between
+        old_library (which this index was built from) and library applied.
+        Only the added, removed and modified tracks and playlists are
+        normalized and re-indexed."""
+        index = copy.copy(self)
+        for name in ('titles', 'artists', 'albums', 'playlists',
+                     'track_artists', 'artist_names', 'album_names', 'playlist_names',
+                     'playlist_contents', 'playlist_keys',
+                     'title_sounds', 'artist_sounds', 'album_sounds'):
+            setattr(index, name, dict(getattr(self, name)))
+
+        for name in ('title_search', 'artist_search', 'album_search',
+                     'playlist_search'):
+            setattr(index, name, getattr(self, name).copy())
+
+        index._copied = set()
+
+        removed, added = changed_tracks(old_library.songs, library.songs)
+        for track_id in removed:
+            index._remove_track(track_id, old_library.songs[track_id])
+        for track_id in added:
+            index._add_track(track_id, library.songs[track_id])
+
+        index._update_playlists(library)
+
+        print(f"Library changes: {len(removed)} tracks removed, {len(added)} added")
+        return index
+
+    def __getstate__(self):
+        # A pickled (snapshot) index shares nothing with any other index
+        state = self.__dict__.copy()
+        state['_copied'] = None
+        return state
+
+    @property
+    def num_tracks(self):
+        return len(self.track_artists)
+
+    @property
+    def num_playlists(self):
+        return len(self.playlist_contents)
+
+    def _track_ids(self, mapping, key):
+        """The list of track IDs (or for the sound maps, keys) for key in
+        mapping, ready to be modified. Lists still shared with the index this one was updated from are
+        copied first."""
+        track_ids = mapping.get(key)
+        if track_ids is None:
+            track_ids = mapping[key] = []
+            if self._copied is not None:
+                self._copied.add((id(mapping), key))
+        elif self._copied is not None and (id(mapping), key) not in self._copied:
+            track_ids = mapping[key] = list(track_ids)
+            self._copied.add((id(mapping), key))
+
+        return track_ids
+
+    def _add_key(self, mapping, search, sounds, key, track_id):
+        track_ids = self._track_ids(mapping, key)
+        if not track_ids:
+            # A new key
+            sound = sound_key(key)
+            if len(sound) >= MIN_SOUND_KEY:
+                self._track_ids(sounds, sound).append(key)
+        track_ids.append(track_id)
+        search.add(key)
+
+    def _remove_key(self, mapping, search, sounds, key, track_id):
+        track_ids = self._track_ids(mapping, key)
+        if track_id in track_ids:
+            track_ids.remove(track_id)
+
+        if not track_ids:
+            del mapping[key]
+            search.remove(key)
+
+            sound = sound_key(key)
+            if sound in sounds:
+                keys = self._track_ids(sounds, sound)
+                keys.remove(key)
+                if not keys:
+                    del sounds[sound]
+            return True
+
+        return False
+
+    def _add_track(self, track_id, song):
+        if song.name:
+            self._add_key(self.titles, self.title_search, self.title_sounds,
+                          normalize_key(song.name), track_id)
+
+        normalized_artist = normalize_key(song.artist) if song.artist else None
+        self.track_artists[track_id] = normalized_artist
+        if normalized_artist:
+            self._add_key(self.artists, self.artist_search, self.artist_sounds,
+                          normalized_artist, track_id)
+            self.artist_names.setdefault(normalized_artist, song.artist)
+
+        if song.album is not None:
+            normalized_album = normalize_key(song.album)
+            self._add_key(self.albums, self.album_search, self.album_sounds,
+                          normalized_album, track_id)
+            self.album_names.setdefault(normalized_album, song.album)
+
+    def _remove_track(self, track_id, song):
+        if song.name:
+            self._remove_key(self.titles, self.title_search, self.title_sounds,
+                             normalize_key(song.name), track_id)
+
+        normalized_artist = self.track_artists.pop(track_id, None)
+        if normalized_artist:
+            if self._remove_key(self.artists, self.artist_search, self.artist_sounds,
+                                normalized_artist, track_id):
+                del self.artist_names[normalized_artist]
+
+        if song.album is not None:
+            normalized_album = normalize_key(song.album)
+            if self._remove_key(self.albums, self.album_search, self.album_sounds,
+                                normalized_album, track_id):
+                del self.album_names[normalized_album]
+
+    def _update_playlists(self, library):
+        """Bring the playlist keys in line with the playlists in library,
+        re-indexing only those whose name or tracks changed"""
+        contents = {}
+        for playlist in library.playlists:
+            if playlist.name in IGNORED_PLAYLISTS:
+                continue
+
+            playlist_id = playlist.persistent_id or playlist.name
+            contents[playlist_id] = (playlist.name, playlist.track_ids)
+
+        changed = {playlist_id for playlist_id in contents.keys() | self.playlist_contents.keys()
+                   if contents.get(playlist_id) != self.playlist_contents.get(playlist_id)}
+        if not changed:
+            return
+
+        # Several playlists can share a normalized name, so every key touched
+        # by a change is rebuilt from all of the playlists carrying it.
+        changed_names = {contents[playlist_id][0] for playlist_id in changed
+                         if playlist_id in contents}
+        changed_names.update(self.playlist_contents[playlist_id][0] for playlist_id in changed
+                             if playlist_id in self.playlist_contents)
+        for name in changed_names:
+            if name not in self.playlist_keys:
+                self.playlist_keys[name] = normalize_key(name)
+        changed_keys = {self.playlist_keys[name] for name in changed_names}
+
+        for key in changed_keys:
+            self.playlists.pop(key, None)
+            self.playlist_names.pop(key, None)
+            self.playlist_search.remove(key)
+
+        for name, track_ids in contents.values():
+            normalized_name = self.playlist_keys.get(name)
+            if normalized_name is None:
+                normalized_name = self.playlist_keys[name] = normalize_key(name)
+            if normalized_name not in changed_keys:
+                continue
+
+            self.playlist_names.setdefault(normalized_name, name)
+            self._track_ids(self.playlists, normalized_name).extend(track_ids)
+            self.playlist_search.add(normalized_name)
+
+        self.playlist_contents = contents
+
+def changed_tracks(old_songs, new_songs):
+    """Compare two track ID -> song mappings. Returns the sets of track IDs to
+    remove from and add to an index built from old_songs. A track whose ID
+    now refers to a different persistent ID, or whose indexed fields changed,
+    is both removed and re-added."""
+    removed = old_songs.keys() - new_songs.keys()
+    added = new_songs.keys() - old_songs.keys()
+
+    for track_id in old_songs.keys() & new_songs.keys():
+        old = old_songs[track_id]
+        new = new_songs[track_id]
+        if (old.persistent_id, old.name, old.artist, old.album) != \
+           (new.persistent_id, new.name, new.artist, new.album):
+            removed.add(track_id)
+            added.add(track_id)
+
+    return removed, added
+
+def sound_match(query, sounds):
+    """The key in sounds (phonetic key -> normalized keys) that sounds like
+    query, as a [(score, key)] list like TrigramIndex.match's, or [] if none
+    does. A key only sounds like query if it also has about as many
+    syllables; of several that do, the closest spelled wins. One dict
+    lookup, however big the library."""
+    sound = sound_key(query)
+    if len(sound) < MIN_SOUND_KEY:
+        return []
+
+    wanted = syllables(query)
+    keys = [key for key in sounds.get(sound) or ()
+            if abs(syllables(key) - wanted) <= min(syllables(key), wanted) // SYLLABLE_SLACK]
+    if not keys:
+        return []
+
+    return [max((ratio(key, query), key) for key in keys)]
+
+def trigrams(text):
+    """The set of distinct character trigrams of text, padded so that the
+    start and end of the string count as well"""
+    padded = f"  {text}  "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class TrigramIndex:
+    """Inverted index from character trigrams to normalized keys.
+
+    Used to prune the keys worth handing to fuzz.ratio down to the few that
+    could possibly reach the match threshold. The pruning is exact: fuzz.ratio
+    is at most 1 - d/(len(a) + len(b)), where d is the insert/delete edit
+    distance between the strings, and each insert or delete can remove at most
+    three of a string's trigrams. So any key scoring at or above the threshold
+    must be close in length to the query and share a minimum number of
+    trigrams with it, and everything else can be skipped unscored."""
+
+    def __init__(self, keys=()):
+        self.postings = {}
+        self.sizes = {}  # key -> number of distinct trigrams in the key
+
+        # keys by length, for the (low threshold) case where a key could
+        # match without sharing any trigrams with the query at all.
+        self.by_length = {}
+
+        # sets still shared with the index this one was copied from
+        self._shared = set()
+
+        for key in keys:
+            self.add(key)
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shared'] = set()
+        return state
+
+    def copy(self):
+        """A copy that can be modified without touching this index. The key
+        sets are only copied once the copy actually changes them."""
+        index = TrigramIndex()
+        index.postings = dict(self.postings)
+        index.sizes = dict(self.sizes)
+        index.by_length = dict(self.by_length)
+        index._shared = {('gram', gram) for gram in index.postings}
+        index._shared.update(('length', length) for length in index.by_length)
+        return index
+
+    def _keys(self, mapping, kind, value):
+        keys = mapping.get(value)
+        if keys is None:
+            keys = mapping[value] = set()
+        elif (kind, value) in self._shared:
+            keys = mapping[value] = set(keys)
+            self._shared.discard((kind, value))
+
+        return keys
+
+    def add(self, key):
+        if key in self.sizes:
+            return
+
+        grams = trigrams(key)
+        self.sizes[key] = len(grams)
+        self._keys(self.by_length, 'length', len(key)).add(key)
+        for gram in grams:
+            self._keys(self.postings, 'gram', gram).add(key)
+
+    def remove(self, key):
+        if self.sizes.pop(key, None) is None:
+            return
+
+        self._keys(self.by_length, 'length', len(key)).discard(key)
+        for gram in trigrams(key):
+            self._keys(self.postings, 'gram', gram).discard(key)
+
+    def candidates(self, query, threshold):
+        """Keys that could score at least threshold against query"""
+        # The smallest ratio that fuzz.ratio will round up to the threshold
+        min_ratio = (threshold - 0.5) / 100
+        if min_ratio <= 0:
+            return set(self.sizes)
+
+        query_grams = trigrams(query)
+        query_len = len(query)
+        min_len = query_len * min_ratio / (2 - min_ratio)
+        max_len = query_len * (2 - min_ratio) / min_ratio
+
+        shared = Counter()
+        for gram in query_grams:
+            shared.update(self.postings.get(gram, ()))
+
+        # Lengths short enough that a key might not need to share anything
+        # with the query. For the usual thresholds this never happens.
+        for length in range(int(min_len), int(max_len) + 1):
+            max_edits = int((1 - min_ratio) * (query_len + length))
+            if len(query_grams) - 3 * max_edits <= 0:
+                for key in self.by_length.get(length, ()):
+                    shared.setdefault(key, 0)
+
+        result = set()
+        for key, count in shared.items():
+            key_len = len(key)
+            if not min_len <= key_len <= max_len:
+                continue
+
+            max_edits = int((1 - min_ratio) * (query_len + key_len))
+            needed = max(len(query_grams), self.sizes[key]) - 3 * max_edits
+            if count >= needed:
+                result.add(key)
+
+        return result
+
+    def match(self, query, threshold, limit=MATCH_LIMIT):
+        """Score the candidates for query with fuzz.ratio, and return up to
+        limit (score, key) pairs at or above threshold, best first. A limit of
+        None returns all of them."""
+        scored = extract(query, self.candidates(query, threshold), threshold)
+
+        if limit is None:
+            return sorted(scored, reverse=True)
+
+        return heapq.nlargest(limit, scored)
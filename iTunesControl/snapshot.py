@@ -0,0 +1,41 @@
+"""The loaded library and its search index, saved to disk.
+
+Parsing a big library XML and indexing it takes a while. A snapshot of the
+result, tagged with the mtime, size and hash of the XML it came from, loads
+in a fraction of the time, so the server can answer requests right away on
+startup and only reparse if the XML has changed since."""
+
+import os
+import pickle
+
+# Bump whenever Library, Track, Playlist or SearchIndex change shape, or the
+# index's keys are worked out differently, so old snapshots are ignored
+# instead of half loaded.
+SNAPSHOT_VERSION = 4
+
+def save_snapshot(path, source, library, index):
+    """Write the snapshot. source is the (path, mtime, size, hash) of the
+    XML the library was loaded from."""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'wb') as snapshot_file:
+        pickle.dump((SNAPSHOT_VERSION, source), snapshot_file, pickle.HIGHEST_PROTOCOL)
+        pickle.dump((library, index), snapshot_file, pickle.HIGHEST_PROTOCOL)
+    # Readers only ever see a whole snapshot
+    os.replace(temp_path, path)
+
+def load_snapshot(path, accept):
+    """(source, library, index) from the snapshot at path, or None if there
+    isn't one, or accept(source) turns it down"""
+    try:
+        with open(path, 'rb') as snapshot_file:
+            version, source = pickle.load(snapshot_file)
+            if version != SNAPSHOT_VERSION or not accept(source):
+                return None
+            library, index = pickle.load(snapshot_file)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Unable to load library snapshot: {e}")
+        return None
+
+    return source, library, index
@@ -0,0 +1,393 @@
+"""The library kept in an SQLite database, for libraries too big to want in
+memory.
+
+Selected with
+
+    [iTunes]
+    backend = sqlite
+    database = Library.sqlite
+
+The loader (see loader.py) writes the database in place of the snapshot, and
+the server opens it instead of unpickling one. Tracks and playlists go in
+plain tables, along with the normalized keys the handlers match on, and each
+kind of key (titles, artists, albums, playlists) gets an FTS5 table. A lookup
+takes the best few FTS matches for the query and scores only those with
+fuzz.ratio, where the in-memory index scores every key its trigram index
+can't rule out. So a near miss can occasionally rank below the cut, but
+memory stays small however big the library is, and the database is there to
+query by hand:
+
+    sqlite3 Library.sqlite "SELECT name, artist FROM tracks WHERE album_key MATCH ..."
+
+StoreLibrary and StoreIndex stand in for Library and SearchIndex, so the
+intent handlers work the same with either."""
+
+import os
+import json
+import heapq
+import sqlite3
+import threading
+from collections.abc import Mapping
+
+from .library import Track, Playlist, TRACK_FIELDS
+from .search import normalize_key, IGNORED_PLAYLISTS, MATCH_LIMIT, MIN_SOUND_KEY
+from .phonetic import sound_key
+from .scoring import extract
+
+STORE_VERSION = 4
+
+# How much of the database to map, which is all of any likely library
+MMAP_SIZE = 1 << 30
+
+# How many of the best FTS matches are scored with fuzz.ratio
+CANDIDATE_LIMIT = 50
+
+TRACK_COLUMNS = tuple(TRACK_FIELDS.values())
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE tracks (
+    track_id INTEGER PRIMARY KEY,
+    name TEXT,
+    artist TEXT,
+    album TEXT,
+    track_number INTEGER,
+    disc_number INTEGER,
+    persistent_id TEXT,
+    play_count INTEGER,
+    title_key TEXT,
+    artist_key TEXT,
+    album_key TEXT
+);
+CREATE TABLE playlists (
+    playlist_id INTEGER PRIMARY KEY,
+    persistent_id TEXT,
+    name TEXT,
+    playlist_key TEXT
+);
+CREATE TABLE playlist_tracks (
+    playlist_id INTEGER,
+    position INTEGER,
+    track_id INTEGER
+);
+CREATE TABLE sounds (kind TEXT, sound TEXT, key TEXT);
+"""
+
+INDEXES = """
+CREATE INDEX tracks_title ON tracks (title_key);
+CREATE INDEX tracks_artist ON tracks (artist_key);
+CREATE INDEX tracks_album ON tracks (album_key);
+CREATE INDEX playlists_key ON playlists (playlist_key);
+CREATE INDEX playlist_tracks_playlist ON playlist_tracks (playlist_id, position);
+CREATE INDEX sounds_sound ON sounds (kind, sound);
+"""
+
+# FTS table -> (the table and column its keys come from)
+KEY_TABLES = {
+    'title_keys': ('tracks', 'title_key'),
+    'artist_keys': ('tracks', 'artist_key'),
+    'album_keys': ('tracks', 'album_key'),
+    'playlist_keys': ('playlists', 'playlist_key'),
+}
+
+def build_store(path, source, library):
+    """Write library to a new database at path. source is the (path, mtime,
+    size, hash) of the XML it was loaded from."""
+    temp_path = f"{path}.tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+    db = sqlite3.connect(temp_path)
+    db.executescript(SCHEMA)
+
+    # The trigram tokenizer (SQLite 3.34 and up) matches misspelled words
+    # too. Older SQLites make do with matching whole words.
+    try:
+        tokenizer = 'trigram'
+        db.execute("CREATE VIRTUAL TABLE title_keys USING fts5(key, tokenize='trigram')")
+    except sqlite3.OperationalError:
+        tokenizer = 'unicode61'
+        db.execute("CREATE VIRTUAL TABLE title_keys USING fts5(key)")
+    for table in KEY_TABLES:
+        if table != 'title_keys':
+            db.execute(f"CREATE VIRTUAL TABLE {table} USING fts5(key, tokenize='{tokenizer}')")
+
+    # Artists and albums repeat, so normalize each only once
+    normalized = {}
+    def key(text):
+        if text not in normalized:
+            normalized[text] = normalize_key(text)
+        return normalized[text]
+
+    db.executemany(
+        f"INSERT INTO tracks VALUES ({', '.join('?' * (len(TRACK_COLUMNS) + 3))})",
+        (tuple(getattr(song, column) for column in TRACK_COLUMNS) +
+         (normalize_key(song.name) if song.name else None,
+          key(song.artist) or None if song.artist else None,
+          key(song.album) if song.album is not None else None)
+         for song in library.songs.values()))
+
+    for playlist_id, playlist in enumerate(library.playlists):
+        playlist_key = None
+        if playlist.name not in IGNORED_PLAYLISTS:
+            playlist_key = normalize_key(playlist.name)
+        db.execute("INSERT INTO playlists VALUES (?, ?, ?, ?)",
+                   (playlist_id, playlist.persistent_id, playlist.name, playlist_key))
+        db.executemany("INSERT INTO playlist_tracks VALUES (?, ?, ?)",
+                       ((playlist_id, position, track_id)
+                        for position, track_id in enumerate(playlist.track_ids)))
+
+    db.executescript(INDEXES)
+    for table, (source_table, column) in KEY_TABLES.items():
+        db.execute(f"INSERT INTO {table} (key) SELECT DISTINCT {column} "
+                   f"FROM {source_table} WHERE {column} IS NOT NULL")
+
+    # Phonetic keys, as SearchIndex keeps them (see phonetic.py)
+    for kind in ('title', 'artist', 'album'):
+        keys = db.execute(f"SELECT DISTINCT {kind}_key FROM tracks "
+                          f"WHERE {kind}_key IS NOT NULL").fetchall()
+        sounds = ((kind, sound_key(key), key) for key, in keys)
+        db.executemany("INSERT INTO sounds VALUES (?, ?, ?)",
+                       (row for row in sounds if len(row[1]) >= MIN_SOUND_KEY))
+
+    db.executemany("INSERT INTO meta VALUES (?, ?)",
+                   (('version', str(STORE_VERSION)),
+                    ('source', json.dumps(source)),
+                    ('tokenizer', tokenizer)))
+    db.commit()
+    db.close()
+
+    # Readers only ever see a whole database
+    os.replace(temp_path, path)
+
+def retag_store(path, source):
+    """Tag the database at path as loaded from source, for when the XML has
+    changed but nothing in the database would"""
+    db = sqlite3.connect(path)
+    with db:
+        db.execute("UPDATE meta SET value = ? WHERE key = 'source'", (json.dumps(source), ))
+    db.close()
+
+def open_store(path, accept):
+    """(source, library, index) for the database at path, or None if there
+    isn't one, or accept(source) turns it down. The same as load_snapshot,
+    for the sqlite backend."""
+    if not os.path.exists(path):
+        return None
+
+    try:
+        store = Store(path)
+        meta = dict(store.query("SELECT key, value FROM meta"))
+    except sqlite3.Error as e:
+        print(f"Unable to open library database: {e}")
+        return None
+
+    if meta.get('version') != str(STORE_VERSION):
+        return None
+    source = tuple(json.loads(meta['source']))
+    if not accept(source):
+        return None
+
+    store.tokenizer = meta['tokenizer']
+    return source, StoreLibrary(store), StoreIndex(store)
+
+class Store:
+    """The database, opened read only, with a connection for each thread
+    (and process) that uses it"""
+    def __init__(self, path):
+        self.path = path
+        self.tokenizer = None
+        self._local = threading.local()
+        self._inherited = []
+
+    def query(self, sql, args=()):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and self._local.pid != os.getpid():
+            # Opened by the process we were forked from (the uwsgi master,
+            # say). SQLite connections mustn't be used on both sides of a
+            # fork, not even to close them, so it's just kept out of the way.
+            self._inherited.append(connection)
+            connection = None
+
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(
+                f"file:{self.path}?mode=ro", uri=True)
+            # Read the pages straight from the mapped file, which every
+            # process has the one copy of, rather than into a cache of
+            # each connection's own
+            connection.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+            self._local.pid = os.getpid()
+        return connection.execute(sql, args).fetchall()
+
+class Lookup(Mapping):
+    """A read-only mapping answered by the database. sql selects the value
+    (or, with many, values) for a key, and list_sql selects every key."""
+    def __init__(self, store, sql, list_sql, many=False):
+        self.store = store
+        self.sql = sql
+        self.list_sql = list_sql
+        self.many = many
+
+    def __getitem__(self, key):
+        rows = self.store.query(self.sql, (key, ))
+        if not rows:
+            raise KeyError(key)
+        if self.many:
+            return [row[0] for row in rows]
+        return rows[0][0]
+
+    def __iter__(self):
+        return (row[0] for row in self.store.query(self.list_sql))
+
+    def __len__(self):
+        return len(self.store.query(self.list_sql))
+
+class Songs(Lookup):
+    """track ID -> Track"""
+    def __init__(self, store):
+        columns = ', '.join(TRACK_COLUMNS)
+        super().__init__(store, f"SELECT {columns} FROM tracks WHERE track_id = ?",
+                         "SELECT track_id FROM tracks")
+
+    def __getitem__(self, track_id):
+        rows = self.store.query(self.sql, (track_id, ))
+        if not rows:
+            raise KeyError(track_id)
+        return self._track(rows[0])
+
+    def __len__(self):
+        return self.store.query("SELECT count(*) FROM tracks")[0][0]
+
+    def values(self):
+        columns = ', '.join(TRACK_COLUMNS)
+        return [self._track(row) for row in self.store.query(f"SELECT {columns} FROM tracks")]
+
+    @staticmethod
+    def _track(row):
+        track = Track()
+        for column, value in zip(TRACK_COLUMNS, row):
+            setattr(track, column, value)
+        return track
+
+class StoreLibrary:
+    """Library, read from the database"""
+    def __init__(self, store):
+        self.store = store
+        self.songs = Songs(store)
+
+    @property
+    def playlists(self):
+        playlists = []
+        for playlist_id, persistent_id, name in self.store.query(
+                "SELECT playlist_id, persistent_id, name FROM playlists ORDER BY playlist_id"):
+            playlist = Playlist(name, persistent_id)
+            playlist.track_ids.extend(row[0] for row in self.store.query(
+                "SELECT track_id FROM playlist_tracks WHERE playlist_id = ? ORDER BY position",
+                (playlist_id, )))
+            playlists.append(playlist)
+        return playlists
+
+    def getPlaylistNames(self, ignoreList=[
+        "Library", "Music", "Movies", "TV Shows", "Purchased", "iTunes DJ", "Podcasts"
+    ]):
+        return [name for name, in self.store.query(
+                    "SELECT name FROM playlists ORDER BY playlist_id")
+                if name not in ignoreList]
+
+class StoreSearch:
+    """Stands in for a TrigramIndex: FTS finds the candidates, and fuzz.ratio
+    scores them. keys is the Lookup of the keys being searched, to check
+    for an exact match directly."""
+    def __init__(self, store, table, keys):
+        self.store = store
+        self.table = table
+        self.keys = keys
+
+    def __len__(self):
+        return self.store.query(f"SELECT count(*) FROM {self.table}")[0][0]
+
+    def _match_expression(self, query):
+        if self.store.tokenizer == 'trigram':
+            terms = {query[i:i + 3] for i in range(len(query) - 2)}
+        else:
+            terms = set(query.split())
+        return ' OR '.join('"{}"'.format(term.replace('"', '""')) for term in terms)
+
+    def candidates(self, query, threshold=None):
+        """The keys worth scoring against query"""
+        keys = set()
+        if query in self.keys:
+            keys.add(query)
+
+        expression = self._match_expression(query)
+        if expression:
+            keys.update(row[0] for row in self.store.query(
+                f"SELECT key FROM {self.table} WHERE {self.table} MATCH ? "
+                "ORDER BY rank LIMIT ?", (expression, CANDIDATE_LIMIT)))
+        return keys
+
+    def match(self, query, threshold, limit=MATCH_LIMIT):
+        """The same as TrigramIndex.match"""
+        scored = extract(query, self.candidates(query, threshold), threshold)
+
+        if limit is None:
+            return sorted(scored, reverse=True)
+
+        return heapq.nlargest(limit, scored)
+
+class StoreIndex:
+    """SearchIndex, read from the database"""
+    def __init__(self, store):
+        self.store = store
+
+        def track_ids(column):
+            return Lookup(store, f"SELECT track_id FROM tracks WHERE {column} = ? ORDER BY track_id",
+                          f"SELECT DISTINCT {column} FROM tracks WHERE {column} IS NOT NULL",
+                          many=True)
+
+        def names(column, name_column):
+            return Lookup(store, f"SELECT {name_column} FROM tracks WHERE {column} = ? "
+                                 "ORDER BY track_id LIMIT 1",
+                          f"SELECT DISTINCT {column} FROM tracks WHERE {column} IS NOT NULL")
+
+        self.titles = track_ids('title_key')
+        self.artists = track_ids('artist_key')
+        self.albums = track_ids('album_key')
+        self.playlists = Lookup(
+            store,
+            "SELECT track_id FROM playlist_tracks JOIN playlists USING (playlist_id) "
+            "WHERE playlist_key = ? ORDER BY playlist_id, position",
+            "SELECT DISTINCT playlist_key FROM playlists WHERE playlist_key IS NOT NULL",
+            many=True)
+
+        self.track_artists = Lookup(store, "SELECT artist_key FROM tracks WHERE track_id = ?",
+                                    "SELECT track_id FROM tracks")
+
+        self.artist_names = names('artist_key', 'artist')
+        self.album_names = names('album_key', 'album')
+        self.playlist_names = Lookup(
+            store, "SELECT name FROM playlists WHERE playlist_key = ? ORDER BY playlist_id LIMIT 1",
+            "SELECT DISTINCT playlist_key FROM playlists WHERE playlist_key IS NOT NULL")
+
+        def sounds(kind):
+            return Lookup(store, f"SELECT key FROM sounds WHERE kind = '{kind}' AND sound = ?",
+                          f"SELECT DISTINCT sound FROM sounds WHERE kind = '{kind}'",
+                          many=True)
+
+        self.title_sounds = sounds('title')
+        self.artist_sounds = sounds('artist')
+        self.album_sounds = sounds('album')
+
+        self.title_search = StoreSearch(store, 'title_keys', self.titles)
+        self.artist_search = StoreSearch(store, 'artist_keys', self.artists)
+        self.album_search = StoreSearch(store, 'album_keys', self.albums)
+        self.playlist_search = StoreSearch(store, 'playlist_keys', self.playlists)
+
+    @property
+    def num_tracks(self):
+        return self.store.query("SELECT count(*) FROM tracks")[0][0]
+
+    @property
+    def num_playlists(self):
+        return self.store.query(
+            "SELECT count(*) FROM playlists WHERE playlist_key IS NOT NULL")[0][0]